@@ -0,0 +1,97 @@
+"""
+Read DICOM files inside zip/tar archives without extracting them.
+
+Files inside an archive are referred to as '{archive path}!/{member name}' (the form stored in dicomdb.filepath),
+e.g. '/mnt/j/exports/AltID123.zip!/DICOM/IM00001'.
+The scanner streams members one at a time (iter_members);
+organise_for_inbox.py reads single members through a temporary file (local_file).
+"""
+import os
+import shutil
+import zipfile
+import tarfile
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+
+archive_suffixes = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+separator = '!/'
+## Archives kept open per process for random access to members
+open_archives = 16
+
+
+def is_archive(path):
+    return path.lower().endswith(archive_suffixes)
+
+def is_zip(path):
+    return path.lower().endswith('.zip')
+
+def member_path(archive, member):
+    return f'{archive}{separator}{member}'
+
+def split_member_path(path):
+    ## (archive, member) for an archive member path, (None, path) for a normal file
+    if separator in path:
+        archive, member = path.split(separator, 1)
+        if is_archive(archive):
+            return archive, member
+    return None, path
+
+def iter_members(archive):
+    """
+    Yields (member name, file object) for every file in the archive, reading the archive once from start to end.
+    The file object is only valid until the next member is requested.
+    Compressed tars are read as a stream, so nothing is decompressed twice.
+    """
+    if is_zip(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as f:
+                        yield info.filename, f
+    else:
+        with tarfile.open(archive, 'r|*') as tf:
+            for member in tf:
+                if member.isfile():
+                    yield member.name, tf.extractfile(member)
+
+@lru_cache(maxsize=open_archives)
+def open_archive(archive, pid):
+    ## Keyed by pid so forked workers don't share file offsets with their parent
+    if is_zip(archive):
+        return zipfile.ZipFile(archive)
+    return tarfile.open(archive, 'r:*')
+
+def file_size(path):
+    ## Size of a file or (uncompressed) archive member
+    archive, member = split_member_path(path)
+    if archive is None:
+        return os.path.getsize(path)
+    handle = open_archive(archive, os.getpid())
+    if isinstance(handle, zipfile.ZipFile):
+        return handle.getinfo(member).file_size
+    return handle.getmember(member).size
+
+@contextmanager
+def local_file(path, tmp_dir=None):
+    """
+    A filename for readers that only take paths (SimpleITK). Normal files are returned as-is;
+    archive members are written to a temporary file in tmp_dir (use a tmpfs such as /dev/shm to stay off disk)
+    which is removed afterwards.
+    """
+    archive, member = split_member_path(path)
+    if archive is None:
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix='.dcm', dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            handle = open_archive(archive, os.getpid())
+            if isinstance(handle, zipfile.ZipFile):
+                with handle.open(member) as src:
+                    shutil.copyfileobj(src, f)
+            else:
+                shutil.copyfileobj(handle.extractfile(member), f)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
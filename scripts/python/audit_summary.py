@@ -0,0 +1,165 @@
+"""
+Summary tables for the audit database (allScansData_{arm}.db), kept up to date by triggers as the scanner inserts rows.
+
+Patient, study and series level counts plus error counts per directory, so progress questions
+("how many patients/studies/series per modality are scanned, organised and uploaded") are answered
+from small tables instead of GROUP BYs over every row in dicomdb.
+Organised/uploaded flags are synced from the inbox manifest when a report is run.
+
+Run directly to print a progress report.
+"""
+import os
+import sqlite3
+import time
+
+trial_arm = 'AG'
+PROJECT = 'STAMPEDE-AG'
+db_filename = f'./outputs/audit/allScansData_{trial_arm}.db'
+manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
+
+#++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
+summary_schemas = [
+    """CREATE TABLE IF NOT EXISTS series_summary (
+    series_uid text PRIMARY KEY,
+    study_uid text NOT NULL,
+    patient_id text NOT NULL,
+    modality text,
+    n_files integer NOT NULL
+    );""",
+    """CREATE INDEX IF NOT EXISTS series_summary_modality ON series_summary(modality);""",
+    """CREATE TABLE IF NOT EXISTS study_summary (
+    study_uid text PRIMARY KEY,
+    patient_id text NOT NULL,
+    n_series integer NOT NULL,
+    n_files integer NOT NULL,
+    experiment_id text,
+    organised integer NOT NULL DEFAULT 0,
+    uploaded integer NOT NULL DEFAULT 0
+    );""",
+    """CREATE TABLE IF NOT EXISTS patient_summary (
+    patient_id text PRIMARY KEY,
+    trial_arm text,
+    n_studies integer NOT NULL,
+    n_files integer NOT NULL
+    );""",
+    """CREATE TABLE IF NOT EXISTS error_summary (
+    dirname text PRIMARY KEY,
+    n_errors integer NOT NULL
+    );""",
+]
+
+## New series/studies/patients are counted when their first file is inserted.
+## INSERT OR IGNORE of a duplicate row doesn't fire the trigger, so counts aren't inflated by re-scans.
+trigger_schemas = [
+    """CREATE TRIGGER IF NOT EXISTS dicomdb_summary AFTER INSERT ON dicomdb BEGIN
+    INSERT INTO series_summary (series_uid, study_uid, patient_id, modality, n_files)
+        VALUES (NEW.series_uid, NEW.study_uid, NEW.patient_id, NEW.modality, 1)
+        ON CONFLICT(series_uid) DO UPDATE SET n_files = n_files + 1;
+    INSERT INTO study_summary (study_uid, patient_id, n_series, n_files)
+        VALUES (NEW.study_uid, NEW.patient_id, 0, 1)
+        ON CONFLICT(study_uid) DO UPDATE SET n_files = n_files + 1;
+    UPDATE study_summary SET n_series = n_series + 1
+        WHERE study_uid = NEW.study_uid
+        AND (SELECT n_files FROM series_summary WHERE series_uid = NEW.series_uid) = 1;
+    INSERT INTO patient_summary (patient_id, trial_arm, n_studies, n_files)
+        VALUES (NEW.patient_id, NEW.trial_arm, 0, 1)
+        ON CONFLICT(patient_id) DO UPDATE SET n_files = n_files + 1;
+    UPDATE patient_summary SET n_studies = n_studies + 1
+        WHERE patient_id = NEW.patient_id
+        AND (SELECT n_files FROM study_summary WHERE study_uid = NEW.study_uid) = 1;
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS errors_summary AFTER INSERT ON errors BEGIN
+    INSERT INTO error_summary (dirname, n_errors) VALUES (NEW.dirname, 1)
+        ON CONFLICT(dirname) DO UPDATE SET n_errors = n_errors + 1;
+    END;""",
+]
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def init_summaries(conn, triggers=True):
+    ## Create summary tables (and triggers). Backfills from existing rows the first time it's run on a DB.
+    cursor = conn.cursor()
+    for schema in summary_schemas:
+        cursor.execute(schema)
+    empty = cursor.execute("SELECT COUNT(*) FROM series_summary").fetchone()[0] == 0
+    if empty and cursor.execute("SELECT 1 FROM dicomdb LIMIT 1").fetchone() is not None:
+        rebuild_summaries(conn)
+    if triggers:
+        for schema in trigger_schemas:
+            cursor.execute(schema)
+    conn.commit()
+
+def drop_triggers(conn):
+    conn.execute("DROP TRIGGER IF EXISTS dicomdb_summary")
+    conn.execute("DROP TRIGGER IF EXISTS errors_summary")
+    conn.commit()
+
+def rebuild_summaries(conn):
+    ## Recompute every summary table from dicomdb/errors in one pass each (keeps organised/uploaded flags)
+    print('Rebuilding summary tables...')
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM series_summary")
+    cursor.execute("""INSERT INTO series_summary (series_uid, study_uid, patient_id, modality, n_files)
+                      SELECT series_uid, MIN(study_uid), MIN(patient_id), MIN(modality), COUNT(*)
+                      FROM dicomdb GROUP BY series_uid""")
+    flags = cursor.execute("SELECT study_uid, experiment_id, organised, uploaded FROM study_summary").fetchall()
+    cursor.execute("DELETE FROM study_summary")
+    cursor.execute("""INSERT INTO study_summary (study_uid, patient_id, n_series, n_files)
+                      SELECT study_uid, MIN(patient_id), COUNT(*), SUM(n_files)
+                      FROM series_summary GROUP BY study_uid""")
+    cursor.executemany("UPDATE study_summary SET experiment_id = ?, organised = ?, uploaded = ? WHERE study_uid = ?",
+                       [(e, o, u, s) for s, e, o, u in flags])
+    cursor.execute("DELETE FROM patient_summary")
+    cursor.execute("""INSERT INTO patient_summary (patient_id, trial_arm, n_studies, n_files)
+                      SELECT s.patient_id, (SELECT trial_arm FROM dicomdb d WHERE d.patient_id = s.patient_id LIMIT 1),
+                             COUNT(*), SUM(s.n_files)
+                      FROM study_summary s GROUP BY s.patient_id""")
+    cursor.execute("DELETE FROM error_summary")
+    cursor.execute("INSERT INTO error_summary (dirname, n_errors) SELECT dirname, COUNT(*) FROM errors GROUP BY dirname")
+    conn.commit()
+
+def sync_status(conn, manifest_file=manifest_filename):
+    ## Copy organised/uploaded flags for each study from the inbox manifest
+    if not os.path.exists(manifest_file):
+        return
+    conn.execute("ATTACH DATABASE ? AS manifest", (manifest_file,))
+    try:
+        conn.execute("""UPDATE study_summary SET experiment_id = m.experiment_id, organised = 1,
+                            uploaded = EXISTS (SELECT 1 FROM manifest.upload_status u
+                                               WHERE u.experiment_id = m.experiment_id AND u.status_code = '200')
+                        FROM manifest.experiments m WHERE m.study_uid = study_summary.study_uid""")
+        conn.commit()
+    finally:
+        conn.execute("DETACH DATABASE manifest")
+
+def progress_report(conn):
+    ## {modality: {'patients': .., 'studies': .., 'series': .., 'files': .., 'organised_studies': .., 'uploaded_studies': ..}}
+    rows = conn.execute("""SELECT se.modality, COUNT(DISTINCT se.patient_id), COUNT(DISTINCT se.study_uid),
+                                  COUNT(*), SUM(se.n_files),
+                                  COUNT(DISTINCT CASE WHEN st.organised THEN st.study_uid END),
+                                  COUNT(DISTINCT CASE WHEN st.uploaded THEN st.study_uid END)
+                           FROM series_summary se JOIN study_summary st ON st.study_uid = se.study_uid
+                           GROUP BY se.modality ORDER BY se.modality""").fetchall()
+    keys = ['patients', 'studies', 'series', 'files', 'organised_studies', 'uploaded_studies']
+    return {modality: dict(zip(keys, values)) for modality, *values in rows}
+
+def main():
+    conn = sqlite3.connect(db_filename, timeout=60)
+    init_summaries(conn)
+    sync_status(conn)
+    report = progress_report(conn)
+    totals = conn.execute("""SELECT (SELECT COUNT(*) FROM patient_summary), (SELECT COUNT(*) FROM study_summary),
+                                    (SELECT COUNT(*) FROM series_summary), (SELECT COALESCE(SUM(n_errors), 0) FROM error_summary),
+                                    (SELECT SUM(organised) FROM study_summary), (SELECT SUM(uploaded) FROM study_summary)""").fetchone()
+    print(f"{'modality':>10} {'patients':>9} {'studies':>8} {'series':>8} {'files':>10} {'organised':>10} {'uploaded':>9}")
+    for modality, r in report.items():
+        print(f"{str(modality):>10} {r['patients']:>9} {r['studies']:>8} {r['series']:>8} {r['files']:>10} "
+              f"{r['organised_studies']:>10} {r['uploaded_studies']:>9}")
+    print(f"Total: {totals[0]} patients, {totals[1]} studies, {totals[2]} series, {totals[3]} file errors. "
+          f"{totals[4] or 0} studies organised, {totals[5] or 0} uploaded.")
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
@@ -0,0 +1,286 @@
+"""
+Benchmark for organise_for_inbox.py and split_inbox_into_batch.py.
+
+Builds a synthetic DICOM tree, the matching dicomdb audit database (as written by scrape_dicom_directory_v3.py)
+and an AJ-style AltID -> trial number CSV, then times each phase separately:
+- planning: reading dicomdb and working out subject/modality/experiment IDs for every study
+  (no slices are written, but organise still creates each empty session directory, so that's in the time too)
+- rewrite: organise_for_inbox end to end, for each worker/compression setting, with the transfer syntax
+  actually written per modality (read back from the output files)
+- empty_dir_scan: scan_for_empty_directories over the organised inbox
+- batching: sizing + bin packing, then split_inbox_into_batch end to end
+Each phase reports wall time, files/sec and peak RSS. Results go to a JSON file so runs can be compared.
+Runs entirely offline in a temporary directory.
+"""
+import os
+import csv
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import resource
+from datetime import datetime
+import SimpleITK as sitk
+import polars as pl
+import scrape_dicom_directory_v3 as scanner
+import organise_for_inbox as organiser
+import split_inbox_into_batch as splitter
+import inbox_manifest
+
+PROJECT = 'STAMPEDE-BENCH'
+## Scale of the synthetic data
+num_patients = 40
+studies_per_patient = (1, 3)
+series_per_modality = (1, 2)
+slices_per_series = (10, 60)
+image_size = 64
+## Use AJ-style patient IDs (AltID...) that organise maps to trial numbers through the CSV
+altid_patients = True
+## Empty session directories left in the inbox (what an interrupted organise run leaves behind)
+num_empty_dirs = 20
+## Modality mixes for a study, with how often each occurs. The OT/SC/SR/SEG mixes exercise organise's
+## modality filtering; CT+MR is rejected as 'too many modalities'.
+study_types = [
+    (['CT'], 30), (['MR'], 10), (['PT', 'CT'], 15), (['NM', 'CT'], 10),
+    (['CT', 'OT'], 8), (['CT', 'SC'], 8), (['MR', 'SR'], 5), (['CT', 'SEG'], 5), (['CT', 'MR'], 2),
+]
+
+## organise_for_inbox settings to compare: (organise_workers, compress_output)
+organise_settings = [(1, False), (4, False), (4, True)]
+## Batch budgets for split_inbox_into_batch
+batch_bytes = 50 * 1024**2
+batch_files = 2000
+
+output_filename = f'./outputs/benchmarks/organise-{datetime.now().strftime("%Y-%m-%d--%H:%M")}.json'
+uid_root = '1.2.826.0.1.3680043.10.999'
+
+
+class PeakRss:
+    ## Samples this process's resident memory while a phase runs (Linux /proc).
+    ## Worker processes aren't included -- their peak is only available for the whole run (see main)
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+
+    def current(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.current())
+        return False
+
+    def result(self, files=None, **extra):
+        result = {'seconds': self.seconds, 'peak_rss_mb': self.peak / 1024**2,
+                  'files': files, 'files_per_sec': files / self.seconds if files and self.seconds else None}
+        result.update(extra)
+        return result
+
+#### ++++++++++++++++++ SYNTHETIC DATA +++++++++++++++++
+def make_images(n=8):
+    ## A few smooth-plus-noise slices to reuse, so compression ratios are realistic and building the tree is quick
+    images = []
+    for k in range(n):
+        image = sitk.GaussianSource(sitk.sitkInt16, [image_size, image_size], sigma=[image_size / 4] * 2,
+                                    mean=[image_size / 2] * 2, scale=1000)
+        images.append(sitk.Cast(sitk.AdditiveGaussianNoise(image, standardDeviation=20, seed=k + 1), sitk.sitkInt16))
+    return images
+
+def write_slice(image, path, tags):
+    image = sitk.Image(image)
+    for tag, value in tags.items():
+        image.SetMetaData(tag, value)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    writer.SetFileName(path)
+    writer.Execute(image)
+
+def make_dataset(workdir, seed=0):
+    """
+    Writes raw/PatientID/StudyDescription/SeriesDescription/*.dcm, audit.db (dicomdb + errors) and altid.csv.
+    Returns (db_file, csv_file, n_files).
+    """
+    rng = random.Random(seed)
+    images = make_images()
+    raw_dir = os.path.join(workdir, 'raw')
+    db_file = os.path.join(workdir, 'audit.db')
+    csv_file = os.path.join(workdir, 'altid.csv')
+    conn = sqlite3.connect(db_file)
+    conn.execute(scanner.schema)
+    conn.execute(scanner.error_schema)
+    mixes, weights = zip(*study_types)
+
+    rows, id_rows, uid = [], [], 0
+    for p in range(num_patients):
+        patient_id = f'AltID{100 + p}' if altid_patients else f'{2000 + p}'
+        id_rows.append((patient_id, str(50000 + p)))
+        for s in range(rng.randint(*studies_per_patient)):
+            uid += 1
+            study_uid = f'{uid_root}.{uid}'
+            study_date = f'20{10 + s:02d}0101'
+            for modality in rng.choices(mixes, weights)[0]:
+                for _ in range(rng.randint(*series_per_modality)):
+                    uid += 1
+                    series_uid = f'{uid_root}.{uid}'
+                    series_dir = os.path.join(raw_dir, patient_id, f'Study {s}', f'{modality} {series_uid[-6:]}')
+                    os.makedirs(series_dir, exist_ok=True)
+                    for i in range(1, rng.randint(*slices_per_series) + 1):
+                        uid += 1
+                        path = os.path.join(series_dir, f'IM{i:05d}.dcm')
+                        position = f'0\\0\\{2.5 * i}'
+                        write_slice(images[i % len(images)], path, {
+                            '0010|0020': patient_id, '0010|0010': patient_id, '0008|0060': modality,
+                            '0020|000d': study_uid, '0020|000e': series_uid, '0008|0018': f'{uid_root}.{uid}',
+                            '0008|0020': study_date, '0020|0013': str(i), '0020|0032': position})
+                        rows.append((patient_id, 'AJ' if altid_patients else 'AG', series_uid, study_uid, path,
+                                     series_dir, modality, study_date, study_date, study_date, i, position, 1))
+    conn.executemany("""INSERT INTO dicomdb (patient_id, trial_arm, series_uid, study_uid, filepath, dirname, modality,
+                        series_date, study_date, acquisition_date, instance_number, image_position, number_of_frames)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    conn.commit()
+    conn.close()
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['patient_id', 'trialno'])
+        writer.writerows(id_rows)
+    return db_file, csv_file, len(rows)
+
+#### ++++++++++++++++++ PHASES +++++++++++++++++++++++++
+def configure(workdir, db_file, csv_file, name):
+    ## Point organise and split at this run's files. Returns the inbox project directory.
+    target = os.path.join(workdir, f'inbox_{name}', '')
+    organiser.PROJECT = PROJECT
+    organiser.trial_arm = 'AJ' if altid_patients else 'AG'
+    organiser.db_filename = db_file
+    organiser.path_to_csv = csv_file
+    organiser.target_dir = target
+    organiser.manifest_filename = os.path.join(workdir, f'manifest_{name}.db')
+    organiser.error_filename = os.path.join(workdir, f'errors_{name}.db')
+    splitter.PROJECT = PROJECT
+    splitter.manifest_filename = organiser.manifest_filename
+    splitter.source_dir = os.path.join(target, PROJECT)
+    splitter.target_dir = os.path.join(workdir, f'batches_{name}')
+    splitter.max_batch_bytes = batch_bytes
+    splitter.max_batch_files = batch_files
+    return os.path.join(target, PROJECT)
+
+def run_planning(workdir, db_file, csv_file, n_files):
+    ## organise_study with the slice rewrite swapped out -- the timing includes creating the session directories
+    configure(workdir, db_file, csv_file, 'planning')
+    organiser.init_outputs()
+    planned = []
+    process_study = organiser.process_study
+    organiser.process_study = lambda **params: planned.append(params['experiment_id'])
+    try:
+        with PeakRss() as phase:
+            id_df = organiser.load_id_mapping()
+            with sqlite3.connect(db_file) as conn:
+                df = pl.read_database("SELECT * from dicomdb", conn)
+            for row in df.unique("study_uid", maintain_order=True).rows(named=True):
+                subset = df.filter(pl.col("study_uid") == row['study_uid'])
+                organiser.organise_study(subset, row, id_df)
+    finally:
+        organiser.process_study = process_study
+    return phase.result(n_files, experiments=len(planned))
+
+def run_organise(workdir, db_file, csv_file, workers, compress):
+    name = f'{workers}w_{"compressed" if compress else "raw"}'
+    project_dir = configure(workdir, db_file, csv_file, name)
+    organiser.organise_workers = workers
+    organiser.compress_output = compress
+    with PeakRss() as phase:
+        organiser.main()
+    manifest = inbox_manifest.init_manifest(organiser.manifest_filename)
+    files, written = manifest.execute("SELECT COALESCE(SUM(n_files), 0), COALESCE(SUM(n_bytes), 0) FROM experiments").fetchone()
+    compression = {f'{m} ({organiser.transfer_syntax_name(ts)})': dict(x, transfer_syntax=ts)
+                   for (m, ts), x in inbox_manifest.get_compression_report(manifest, PROJECT).items()}
+    manifest.close()
+    result = phase.result(files, workers=workers, compress=compress, bytes_written=written, compression=compression)
+    return name, project_dir, result
+
+def run_empty_dir_scan(project_dir):
+    for i in range(num_empty_dirs):
+        os.makedirs(os.path.join(project_dir, f'EMPTY_{i}'), exist_ok=True)
+    n_dirs = len(os.listdir(project_dir))
+    with PeakRss() as phase:
+        empty_dirs, non_empty_dirs = organiser.scan_for_empty_directories(project_dir)
+    for name in empty_dirs:
+        os.rmdir(os.path.join(project_dir, name))
+    return phase.result(None, directories=n_dirs, dirs_per_sec=n_dirs / phase.seconds if phase.seconds else None,
+                        empty=len(empty_dirs))
+
+def run_batching(project_dir, n_files):
+    manifest = inbox_manifest.init_manifest(splitter.manifest_filename)
+    experiments = [os.path.join(project_dir, x) for x in os.listdir(project_dir)]
+    with PeakRss() as sizing:
+        sizes = splitter.get_sizes(experiments, manifest)
+    with PeakRss() as packing:
+        batches = splitter.pack_batches(sizes, batch_bytes, batch_files)
+    manifest.close()
+    with PeakRss() as phase:
+        splitter.main()
+    return phase.result(n_files, batches=len(batches), sizing=sizing.result(n_files), packing=packing.result(n_files))
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='organise-bench-')
+    results = {'settings': {'num_patients': num_patients, 'studies_per_patient': studies_per_patient,
+                            'series_per_modality': series_per_modality, 'slices_per_series': slices_per_series,
+                            'image_size': image_size, 'altid_patients': altid_patients, 'study_types': study_types,
+                            'batch_bytes': batch_bytes, 'batch_files': batch_files}}
+    try:
+        start = time.time()
+        db_file, csv_file, n_files = make_dataset(workdir)
+        print(f'Built synthetic tree with {n_files} files in {time.time() - start:.0f}s ({workdir})')
+        results['dataset'] = {'files': n_files, 'build_seconds': time.time() - start}
+
+        results['planning'] = run_planning(workdir, db_file, csv_file, n_files)
+        results['rewrite'] = {}
+        for workers, compress in organise_settings:
+            name, project_dir, result = run_organise(workdir, db_file, csv_file, workers, compress)
+            results['rewrite'][name] = result
+        ## Scan and batch the output of the last organise run
+        results['empty_dir_scan'] = run_empty_dir_scan(project_dir)
+        results['batching'] = run_batching(project_dir, results['rewrite'][name]['files'])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    ## getrusage keeps the largest child ever reaped, so it can't be split by phase
+    results['children_max_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    print(f"{'phase':>24} {'seconds':>9} {'files/sec':>10} {'peak RSS (MB)':>14}")
+    phases = [('planning', results['planning'])] + [(f'rewrite {k}', v) for k, v in results['rewrite'].items()] + \
+             [('empty_dir_scan', results['empty_dir_scan']), ('batching', results['batching'])]
+    for name, r in phases:
+        rate = '' if r['files_per_sec'] is None else f"{r['files_per_sec']:.0f}"
+        print(f"{name:>24} {r['seconds']:>9.2f} {rate:>10} {r['peak_rss_mb']:>14.0f}")
+    print(f"Largest worker process: {results['children_max_rss_mb']:.0f} MB RSS")
+    for name, r in results['rewrite'].items():
+        for key, x in sorted(r['compression'].items()):
+            ratio = 'n/a' if x['ratio'] is None else f"{x['ratio']:.2f}x"
+            print(f"    rewrite {name}: {key} ratio {ratio}")
+
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    with open(output_filename, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output_filename}')
+
+
+if __name__ == '__main__':
+    main()
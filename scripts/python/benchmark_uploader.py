@@ -0,0 +1,127 @@
+"""
+Load-test harness for upload-from-inbox.py.
+
+Builds a synthetic inbox, starts mock_xnat.py in-process and runs the uploader's main_loop against it
+for each concurrency setting and upload order. Reports experiments/minute, retries and latency percentiles,
+and writes the results to a JSON file so runs can be compared.
+"""
+import os
+import json
+import random
+import shutil
+import tempfile
+import time
+import importlib.util
+from datetime import datetime
+import mock_xnat
+import xnat_cache
+
+PROJECT = 'STAMPEDE-TEST'
+## Synthetic inbox: number of experiments and range of files per experiment
+num_experiments = 200
+files_per_experiment = (10, 500)
+file_size = 512 # bytes, contents are irrelevant to the mock
+
+## Uploader settings to compare
+concurrency_settings = [1, 2, 4, 8, 16]
+upload_orders = ['glob', 'largest-first', 'round-robin-subject']
+max_retries = 3
+retry_backoff = 0.1
+
+## Mock XNAT behaviour (see mock_xnat.py)
+mock_settings = {
+    'base_latency': 0.01,
+    'import_latency': 0.05,
+    'import_seconds_per_file': 0.0005,
+    'error_rates': {'listing': 0.0, 'experiment': 0.0, 'import': 0.02, 'active': 0.0},
+    'max_concurrent_imports': 4,
+    'import_queue_timeout': 5,
+}
+
+output_filename = f'./outputs/benchmarks/uploader-{datetime.now().strftime("%Y-%m-%d--%H:%M")}.json'
+uploader_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload-from-inbox.py')
+
+
+def load_uploader():
+    ## upload-from-inbox.py can't be imported by name because of the hyphens
+    spec = importlib.util.spec_from_file_location('upload_from_inbox', uploader_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_inbox(root, seed=0):
+    rng = random.Random(seed)
+    project_dir = os.path.join(root, PROJECT)
+    os.makedirs(project_dir, exist_ok=True)
+    for i in range(num_experiments):
+        session_path = os.path.join(project_dir, f'{1000 + i // 3}_CT_{i}')
+        os.makedirs(session_path, exist_ok=True)
+        for j in range(rng.randint(*files_per_experiment)):
+            with open(os.path.join(session_path, f'{j}.dcm'), 'wb') as f:
+                f.write(b'\0' * file_size)
+    return project_dir + os.sep
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def run(workdir, source_dir, concurrency, order):
+    server, xnat = mock_xnat.start_server(mock_xnat.MockXnat(inbox_root=os.path.join(workdir, ''), **mock_settings))
+    uploader = load_uploader()
+    uploader.PROJECT = PROJECT
+    uploader.url = f'http://localhost:{server.server_address[1]}'
+    uploader.max_workers = concurrency
+    uploader.upload_order = order
+    uploader.max_retries = max_retries
+    uploader.retry_backoff = retry_backoff
+    uploader.manifest_filename = os.path.join(workdir, f'manifest_{order}_{concurrency}.db')
+    uploader.cache_conn = xnat_cache.init_cache(os.path.join(workdir, f'cache_{order}_{concurrency}.db'))
+
+    start = time.time()
+    results = uploader.main_loop(source_dir, None)
+    elapsed = time.time() - start
+    server.shutdown()
+
+    latencies = [x['elapsed'] for x in results]
+    succeeded = [x for x in results if x['status'] == 200]
+    return {
+        'concurrency': concurrency,
+        'order': order,
+        'experiments': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'retries': sum(x['attempts'] - 1 for x in results),
+        'wall_time': elapsed,
+        'experiments_per_minute': 60 * len(succeeded) / elapsed if elapsed else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies) if latencies else None,
+        'requests': dict(xnat.request_counts),
+    }
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='xnat-bench-')
+    try:
+        source_dir = make_inbox(workdir)
+        print(f'Built synthetic inbox with {num_experiments} experiments in {source_dir}')
+        runs = [run(workdir, source_dir, c, o) for o in upload_orders for c in concurrency_settings]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'order':>20} {'workers':>8} {'expt/min':>10} {'failed':>7} {'retries':>8} {'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8}")
+    for r in runs:
+        print(f"{r['order']:>20} {r['concurrency']:>8} {r['experiments_per_minute']:>10.1f} {r['failed']:>7} {r['retries']:>8} "
+              f"{r['latency_p50']:>8.2f} {r['latency_p95']:>8.2f} {r['latency_p99']:>8.2f}")
+
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    with open(output_filename, 'w') as f:
+        json.dump({'settings': {'num_experiments': num_experiments, 'files_per_experiment': files_per_experiment,
+                                'mock': mock_settings}, 'runs': runs}, f, indent=2)
+    print(f'Results written to {output_filename}')
+
+
+if __name__ == '__main__':
+    main()
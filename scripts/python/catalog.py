@@ -0,0 +1,150 @@
+"""
+Cross-arm catalog over the per-arm audit databases (allScansData_{arm}.db).
+
+Series from every arm are merged into one indexed table keyed by patient ID, study UID and series UID,
+with the arm and source database each row came from. Refreshes are incremental: only rows added to an
+arm DB since the last refresh are read (an arm is rebuilt if rows were removed from it, e.g. by de-duplication).
+
+Run directly to refresh the catalog and list patients/studies that appear in more than one arm.
+"""
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+arm_databases = {
+    'AG': './outputs/audit/allScansData_AG.db',
+    'AH': './outputs/audit/allScansData_AH.db',
+    'AJ': './outputs/audit/allScansData_AJ.db',
+    'ACE': './outputs/audit/allScansData_ACE.db',
+}
+catalog_filename = './outputs/audit/catalog.db'
+
+#++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
+catalog_schemas = [
+    """CREATE TABLE IF NOT EXISTS catalog_series (
+    trial_arm text NOT NULL,
+    series_uid text NOT NULL,
+    study_uid text NOT NULL,
+    patient_id text NOT NULL,
+    modality text,
+    study_date text,
+    n_files integer NOT NULL,
+    source_db text NOT NULL,
+    first_seen text,
+    PRIMARY KEY (trial_arm, series_uid)
+    );""",
+    "CREATE INDEX IF NOT EXISTS catalog_series_uid ON catalog_series(series_uid);",
+    "CREATE INDEX IF NOT EXISTS catalog_study_uid ON catalog_series(study_uid, trial_arm);",
+    "CREATE INDEX IF NOT EXISTS catalog_patient_id ON catalog_series(patient_id, trial_arm);",
+    """CREATE TABLE IF NOT EXISTS sources (
+    trial_arm text PRIMARY KEY,
+    source_db text NOT NULL,
+    last_id integer NOT NULL,
+    n_rows integer,
+    mtime real,
+    refreshed_at text
+    );""",
+]
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def init_catalog(db_file=catalog_filename):
+    ## uri=True so arm DBs can be attached read-only
+    conn = sqlite3.connect(db_file, timeout=60, uri=True)
+    for schema in catalog_schemas:
+        conn.execute(schema)
+    ## Catalogs made before row counts were tracked -- a NULL count rebuilds the arm on the next refresh
+    if 'n_rows' not in [x[1] for x in conn.execute("PRAGMA table_info(sources)")]:
+        conn.execute("ALTER TABLE sources ADD COLUMN n_rows integer")
+    conn.commit()
+    return conn
+
+def source_mtime(source_db):
+    ## Newest of the DB and its write-ahead log -- recent commits may only be in the -wal file
+    return max(os.path.getmtime(x) for x in [source_db, f'{source_db}-wal'] if os.path.exists(x))
+
+def refresh_arm(conn, trial_arm, source_db):
+    ## Merge rows added to one arm DB since the last refresh. Returns the number of rows read.
+    if not os.path.exists(source_db):
+        print(f'{trial_arm}: {source_db} not found, skipping')
+        return 0
+    mtime = source_mtime(source_db)
+    state = conn.execute("SELECT last_id, mtime, source_db, n_rows FROM sources WHERE trial_arm = ?", (trial_arm,)).fetchone()
+    if state is not None and state[1] == mtime and state[2] == source_db:
+        return 0
+
+    conn.execute("ATTACH DATABASE ? AS arm", (f'file:{source_db}?mode=ro',))
+    try:
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM arm.dicomdb").fetchone()[0]
+        last_id = 0 if state is None else state[0]
+        if state is not None and (state[2] != source_db or state[3] !=
+                                  conn.execute("SELECT COUNT(*) FROM arm.dicomdb WHERE id <= ?", (last_id,)).fetchone()[0]):
+            ## Rows were removed (or the arm moved to another DB) -- rebuild this arm
+            print(f'{trial_arm}: source changed, rebuilding')
+            conn.execute("DELETE FROM catalog_series WHERE trial_arm = ?", (trial_arm,))
+            last_id = 0
+        conn.execute("""INSERT INTO catalog_series
+                        (trial_arm, series_uid, study_uid, patient_id, modality, study_date, n_files, source_db, first_seen)
+                        SELECT ?, series_uid, MIN(study_uid), MIN(patient_id), MIN(modality), MIN(study_date), COUNT(*), ?, ?
+                        FROM arm.dicomdb WHERE id > ? AND id <= ? GROUP BY series_uid
+                        ON CONFLICT(trial_arm, series_uid) DO UPDATE SET n_files = n_files + excluded.n_files""",
+                     (trial_arm, source_db, datetime.now().isoformat(), last_id, max_id))
+        n_rows = conn.execute("SELECT COUNT(*) FROM arm.dicomdb WHERE id <= ?", (max_id,)).fetchone()[0]
+        conn.execute("""INSERT OR REPLACE INTO sources (trial_arm, source_db, last_id, n_rows, mtime, refreshed_at)
+                        VALUES (?, ?, ?, ?, ?, ?)""", (trial_arm, source_db, max_id, n_rows, mtime, datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.execute("DETACH DATABASE arm")
+    return max_id - last_id
+
+def refresh_catalog(conn, databases=arm_databases):
+    for trial_arm, source_db in databases.items():
+        start = time.time()
+        num_rows = refresh_arm(conn, trial_arm, source_db)
+        if num_rows:
+            print(f'{trial_arm}: merged {num_rows} new rows in {time.time() - start:.1f}s')
+
+def find_patient(conn, patient_id):
+    ## [(trial_arm, study_uid, series_uid, modality, n_files, source_db)] for a patient in any arm
+    return conn.execute("""SELECT trial_arm, study_uid, series_uid, modality, n_files, source_db
+                           FROM catalog_series WHERE patient_id = ?""", (patient_id,)).fetchall()
+
+def find_study(conn, study_uid):
+    return conn.execute("""SELECT trial_arm, patient_id, series_uid, modality, n_files, source_db
+                           FROM catalog_series WHERE study_uid = ?""", (study_uid,)).fetchall()
+
+def cross_arm_duplicates(conn, key='study_uid'):
+    ## {study_uid/patient_id/series_uid: [arms]} for keys found in more than one arm
+    assert key in ('patient_id', 'study_uid', 'series_uid')
+    rows = conn.execute(f"""SELECT {key}, GROUP_CONCAT(DISTINCT trial_arm) FROM catalog_series
+                            GROUP BY {key} HAVING COUNT(DISTINCT trial_arm) > 1""").fetchall()
+    return {k: arms.split(',') for k, arms in rows}
+
+def attach_arms(conn, databases=arm_databases):
+    ## File-level view over every arm DB (columns common to all scanner versions, plus source_db): TEMP VIEW all_dicomdb.
+    ## (SQLite attaches up to 10 databases by default)
+    selects = []
+    for i, (trial_arm, source_db) in enumerate(databases.items()):
+        if not os.path.exists(source_db):
+            continue
+        conn.execute(f"ATTACH DATABASE ? AS arm_{i}", (f'file:{source_db}?mode=ro',))
+        selects.append(f"""SELECT id, patient_id, trial_arm, series_uid, study_uid, filepath, modality, study_date,
+                           '{source_db}' AS source_db FROM arm_{i}.dicomdb""")
+    conn.execute("DROP VIEW IF EXISTS temp.all_dicomdb")
+    conn.execute(f"CREATE TEMP VIEW all_dicomdb AS {' UNION ALL '.join(selects)}")
+
+def main():
+    conn = init_catalog(catalog_filename)
+    refresh_catalog(conn)
+    for key in ['patient_id', 'study_uid']:
+        duplicates = cross_arm_duplicates(conn, key)
+        print(f'{len(duplicates)} {key}s appear in more than one arm')
+        for k, arms in list(duplicates.items())[:20]:
+            print(f'    {k}: {arms}')
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
@@ -0,0 +1,183 @@
+"""
+C-STORE transport for upload-from-inbox.py (transport = 'cstore'): sends the organised slices to XNAT's
+DICOM receiver (port 8104 in docker-compose.yml) instead of asking XNAT to import them from the inbox.
+
+A pool of long-lived associations is kept open and shared by the upload workers; each experiment is sent over one
+association. Presentation contexts are requested for the exact SOP class / transfer syntax pairs found in the files,
+so compressed data is sent as-is rather than transcoded. When a file needs a context the association doesn't have,
+that association is re-negotiated with every context seen so far (so this only happens a few times per run).
+
+XNAT routes each file using the PatientComments field ("Project: P Subject: S Session: E"), which is set
+on the dataset as it is sent -- the files in the inbox aren't modified.
+Sessions received this way land in the prearchive unless the project is set to auto-archive.
+"""
+import os
+import time
+import queue
+import threading
+import pydicom
+from pynetdicom import AE
+from pynetdicom.presentation import build_context
+
+## XNAT DICOM receiver
+scp_host = 'localhost'
+scp_port = 8104
+scp_ae_title = 'XNAT'
+ae_title = 'STAMPEDE_UPLOAD'
+## Seconds to wait for association negotiation and for each response
+acse_timeout = 60
+network_timeout = 300
+## An association can have at most 128 presentation contexts
+max_contexts = 128
+## C-STORE statuses treated as success: 0x0000 and the warnings (coercion, elements discarded)
+success_statuses = {0x0000, 0xB000, 0xB006, 0xB007}
+
+
+class PooledAssociation:
+    ## One long-lived association plus its throughput metrics
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.assoc = None
+        self.accepted = set() # (sop_class_uid, transfer_syntax_uid)
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = 0
+        self.connects = 0
+
+    def connect(self):
+        self.close()
+        contexts = [build_context(sop_class, transfer_syntax) for sop_class, transfer_syntax in self.pool.get_contexts()]
+        self.assoc = self.pool.ae.associate(self.pool.host, self.pool.port, contexts=contexts, ae_title=self.pool.scp_ae_title)
+        self.connects += 1
+        if not self.assoc.is_established:
+            self.assoc = None
+            raise ConnectionError(f'Association {self.index} with {self.pool.scp_ae_title}@{self.pool.host}:{self.pool.port} was rejected or aborted')
+        self.accepted = {(cx.abstract_syntax, cx.transfer_syntax[0]) for cx in self.assoc.accepted_contexts}
+
+    def close(self):
+        if self.assoc is not None and self.assoc.is_established:
+            self.assoc.release()
+        self.assoc = None
+
+    def send(self, ds, n_bytes):
+        ## C-STORE one dataset, (re)negotiating if the association is down or lacks the context. Returns the status
+        ## (None if the receiver doesn't accept the context); raises ConnectionError if the association drops.
+        key = (str(ds.SOPClassUID), str(ds.file_meta.TransferSyntaxUID))
+        if key not in self.accepted:
+            self.pool.add_context(key)
+        if self.assoc is None or not self.assoc.is_established or key not in self.accepted:
+            self.connect()
+        if key not in self.accepted:
+            ## The receiver won't take this syntax -- report it rather than transcoding
+            self.failures += 1
+            return None
+        start = time.perf_counter()
+        response = self.assoc.send_c_store(ds)
+        self.seconds += time.perf_counter() - start
+        ## pynetdicom returns an empty response (no exception) when the association aborts or the DIMSE call times out
+        if response is None or 'Status' not in response:
+            self.close()
+            raise ConnectionError(f'Association {self.index} dropped during C-STORE')
+        status = response.Status
+        if status in success_statuses:
+            self.files += 1
+            self.bytes += n_bytes
+        else:
+            self.failures += 1
+        return status
+
+    def metrics(self):
+        return {'association': self.index, 'files': self.files, 'bytes': self.bytes, 'seconds': self.seconds,
+                'MB_per_sec': self.bytes / 1e6 / self.seconds if self.seconds else None,
+                'failures': self.failures, 'connects': self.connects}
+
+
+class AssociationPool:
+    ## `size` associations, handed out to one upload worker at a time
+    def __init__(self, size, host=scp_host, port=scp_port, scp_ae_title=scp_ae_title, ae_title=ae_title):
+        self.host = host
+        self.port = port
+        self.scp_ae_title = scp_ae_title
+        self.ae = AE(ae_title=ae_title)
+        self.ae.acse_timeout = acse_timeout
+        self.ae.network_timeout = network_timeout
+        self.lock = threading.Lock()
+        self.contexts = [] # (sop_class_uid, transfer_syntax_uid) in the order they were first needed
+        self.associations = [PooledAssociation(self, i) for i in range(size)]
+        self.idle = queue.Queue()
+        for association in self.associations:
+            self.idle.put(association)
+
+    def add_context(self, key):
+        with self.lock:
+            if key in self.contexts:
+                self.contexts.remove(key)
+            self.contexts.append(key)
+
+    def get_contexts(self):
+        ## Most recently needed contexts if there are more than fit in one association
+        with self.lock:
+            return list(self.contexts[-max_contexts:])
+
+    def borrow(self):
+        return self.idle.get()
+
+    def give_back(self, association):
+        self.idle.put(association)
+
+    def metrics(self):
+        return [x.metrics() for x in self.associations]
+
+    def close(self):
+        for association in self.associations:
+            association.close()
+
+
+def routing_comment(project, subject_id, experiment_id):
+    return f'Project: {project} Subject: {subject_id} Session: {experiment_id}'
+
+def send_experiment(pool, upload, project, subject_id, experiment_id, max_retries=3, retry_backoff=30):
+    """
+    Send every file in an organised experiment directory over one pooled association.
+    Retries files that failed because the association dropped. Returns the same result dict as
+    upload-from-inbox.upload_experiment: status is 200 when every file was stored, otherwise the
+    first failing C-STORE status (or 'connection error').
+    """
+    start = time.time()
+    comment = routing_comment(project, subject_id, experiment_id)
+    files = sorted(f.path for f in os.scandir(upload) if f.is_file())
+    status, attempt = 200, 1
+    association = pool.borrow()
+    try:
+        for path in files:
+            ds = pydicom.dcmread(path)
+            ds.PatientComments = comment
+            n_bytes = os.path.getsize(path)
+            while True:
+                try:
+                    file_status = association.send(ds, n_bytes)
+                    break
+                except (ConnectionError, OSError, RuntimeError) as e:
+                    print(f'Association {association.index} failed sending {experiment_id}: {e}')
+                    association.close()
+                    if attempt > max_retries:
+                        file_status = 'connection error'
+                        break
+                    time.sleep(retry_backoff * attempt)
+                    attempt += 1
+            if file_status not in success_statuses:
+                status = f'0x{file_status:04X}' if isinstance(file_status, int) else file_status or 'rejected transfer syntax'
+                print(f'C-STORE of {path} failed: {status}')
+                break
+    finally:
+        pool.give_back(association)
+    return {'path': upload, 'expt_id': experiment_id, 'subject_id': subject_id, 'status': status,
+            'attempts': attempt, 'elapsed': time.time() - start}
+
+def print_metrics(pool):
+    for x in pool.metrics():
+        rate = 'n/a' if x['MB_per_sec'] is None else f"{x['MB_per_sec']:.1f} MB/s"
+        print(f"Association {x['association']}: {x['files']} files, {x['bytes'] / 1e9:.2f} GB in {x['seconds']:.0f}s "
+              f"({rate}), {x['failures']} failures, {x['connects']} connects")
@@ -0,0 +1,194 @@
+"""
+Parquet snapshots of the audit databases for analytics, so queries don't go through the live SQLite files.
+
+Writes dicomdb and errors from every arm DB, and upload_status/verification from the inbox manifests, under snapshot_dir:
+    dicomdb/trial_arm=AG/modality=CT/part-000000000001.parquet
+    errors/trial_arm=AG/part-000000000001.parquet
+    upload_status/project_id=STAMPEDE-AG/part-0.parquet
+Read them with polars lazy scans (predicates on trial_arm/modality skip whole directories, others use the row group statistics):
+    pl.scan_parquet(f'{snapshot_dir}/dicomdb/**/*.parquet', hive_partitioning=True).filter(pl.col('modality') == 'CT')
+
+Exports are incremental: only rows with ids above the last export are read, in id ranges of rows_per_part, each range
+written as one file per partition (named after its first id, so a re-run after a crash overwrites rather than duplicates).
+An arm is re-exported from scratch if rows were removed from it (e.g. bulk-load de-duplication) or its columns changed.
+Each arm is read inside one read transaction, so a snapshot is consistent even while the scanner is writing (WAL mode).
+UID columns are dictionary-encoded and files are sorted by study/series so their min/max statistics stay narrow.
+The manifest tables are small and are rewritten in full on every run.
+
+Run directly to refresh the snapshots.
+"""
+import os
+import glob
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+import polars as pl
+
+from catalog import arm_databases
+
+snapshot_dir = './outputs/snapshots'
+## Manifests to export the upload and verification status from
+manifest_databases = {
+    'STAMPEDE-AG': './outputs/audit/inbox_manifest_STAMPEDE-AG.db',
+}
+manifest_tables = ['upload_status', 'verification']
+## Rows read from the arm DB at a time (one file per modality per range)
+rows_per_part = 500_000
+## Sort order within a file and dictionary-encoded columns
+sort_columns = {'dicomdb': ['study_uid', 'series_uid', 'filepath'], 'errors': ['dirname', 'filepath']}
+uid_columns = ['patient_id', 'study_uid', 'series_uid', 'dirname']
+compression = 'zstd'
+row_group_size = 100_000
+
+## SQLite declared type -> polars type (everything else is exported as text)
+column_types = {'integer': pl.Int64, 'real': pl.Float64}
+
+#++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
+state_schema = """CREATE TABLE IF NOT EXISTS exports (
+    table_name text NOT NULL,
+    source text NOT NULL,
+    source_db text NOT NULL,
+    last_id integer NOT NULL,
+    n_rows integer NOT NULL,
+    columns text NOT NULL,
+    exported_at text,
+    PRIMARY KEY (table_name, source)
+    );"""
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def init_state(directory=snapshot_dir):
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(directory, '_state.db'), timeout=60)
+    conn.execute(state_schema)
+    conn.commit()
+    return conn
+
+def open_source(source_db):
+    ## Read-only connection holding one read transaction, so every query sees the same snapshot
+    conn = sqlite3.connect(f'file:{source_db}?mode=ro', uri=True, timeout=60, isolation_level=None)
+    conn.execute('BEGIN')
+    return conn
+
+def table_schema(conn, table):
+    ## {column: polars type} from the declared column types
+    return {name: column_types.get(decl.lower(), pl.Utf8) for _, name, decl, *_ in conn.execute(f"PRAGMA table_info({table})")}
+
+def has_table(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+def write_part(df, path, table):
+    ## Write to a temporary file and rename, so readers never see a partly written file
+    df = df.sort([c for c in sort_columns.get(table, []) if c in df.columns])
+    dictionary = [c for c in uid_columns if c in df.columns]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    df.write_parquet(tmp_path, compression=compression, statistics=True, row_group_size=row_group_size,
+                     use_pyarrow=True, pyarrow_options={'use_dictionary': dictionary})
+    os.replace(tmp_path, path)
+
+def partition_dir(table, trial_arm, modality=None):
+    path = os.path.join(snapshot_dir, table, f'trial_arm={trial_arm}')
+    if modality is not None:
+        path = os.path.join(path, f'modality={modality}')
+    return path
+
+def write_range(df, table, trial_arm, start_id):
+    ## One file per partition for the rows of one id range. Returns the number of files written.
+    name = f'part-{start_id:012d}.parquet'
+    df = df.drop([c for c in ['trial_arm'] if c in df.columns])
+    if table != 'dicomdb':
+        write_part(df, os.path.join(partition_dir(table, trial_arm), name), table)
+        return 1
+    ## Partition values can't be null or contain path separators
+    df = df.with_columns(pl.col('modality').fill_null('UNKNOWN').str.replace_all('/', '_'))
+    for (modality,), subset in df.group_by(['modality']):
+        write_part(subset.drop('modality'), os.path.join(partition_dir(table, trial_arm, modality), name), table)
+    return df['modality'].n_unique()
+
+def export_arm(state, table, trial_arm, source_db):
+    """
+    Export rows of one arm table added since the last export. Returns the number of rows exported.
+    """
+    if not os.path.exists(source_db):
+        print(f'{trial_arm}: {source_db} not found, skipping')
+        return 0
+    conn = open_source(source_db)
+    try:
+        if not has_table(conn, table):
+            return 0
+        schema = table_schema(conn, table)
+        columns = ','.join(schema)
+        previous = state.execute("SELECT last_id, n_rows, columns, source_db FROM exports WHERE table_name = ? AND source = ?",
+                                 (table, trial_arm)).fetchone()
+        last_id, n_rows = 0, 0
+        if previous is not None:
+            last_id, n_rows = previous[0], previous[1]
+            ## Rows removed (or moved to another DB / columns added) since the last export -- start again
+            unchanged = previous[2] == columns and previous[3] == source_db and \
+                conn.execute(f"SELECT COUNT(*) FROM {table} WHERE id <= ?", (last_id,)).fetchone()[0] == n_rows
+            if not unchanged:
+                print(f'{trial_arm}: {table} changed since the last export, rebuilding')
+                shutil.rmtree(partition_dir(table, trial_arm), ignore_errors=True)
+                last_id, n_rows = 0, 0
+
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        exported, n_files = 0, 0
+        for start_id in range(last_id + 1, max_id + 1, rows_per_part):
+            cursor = conn.execute(f"SELECT * FROM {table} WHERE id >= ? AND id < ? AND id <= ?",
+                                  (start_id, start_id + rows_per_part, max_id))
+            rows = cursor.fetchall()
+            if not rows:
+                continue
+            df = pl.DataFrame(rows, schema=schema, orient='row', strict=False)
+            n_files += write_range(df, table, trial_arm, start_id)
+            exported += len(rows)
+    finally:
+        conn.close()
+
+    state.execute("""INSERT OR REPLACE INTO exports (table_name, source, source_db, last_id, n_rows, columns, exported_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                  (table, trial_arm, source_db, max_id, n_rows + exported, columns, datetime.now().isoformat()))
+    state.commit()
+    if exported:
+        print(f'{trial_arm}: exported {exported} {table} rows to {n_files} files')
+    return exported
+
+def export_manifest(project, manifest_db):
+    ## Small status tables -- rewritten in full
+    if not os.path.exists(manifest_db):
+        print(f'{project}: {manifest_db} not found, skipping')
+        return
+    conn = open_source(manifest_db)
+    try:
+        for table in manifest_tables:
+            if not has_table(conn, table):
+                continue
+            schema = table_schema(conn, table)
+            df = pl.DataFrame(conn.execute(f"SELECT * FROM {table}").fetchall(), schema=schema, orient='row', strict=False)
+            path = os.path.join(snapshot_dir, table, f'project_id={project}', 'part-0.parquet')
+            write_part(df.drop('project_id'), path, table)
+            print(f'{project}: exported {len(df)} {table} rows')
+    finally:
+        conn.close()
+
+def snapshot_size(directory=snapshot_dir):
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(directory, '**', '*.parquet'), recursive=True))
+
+def main():
+    state = init_state(snapshot_dir)
+    for trial_arm, source_db in arm_databases.items():
+        for table in ['dicomdb', 'errors']:
+            start = time.time()
+            if export_arm(state, table, trial_arm, source_db):
+                print(f'{trial_arm}: {table} exported in {time.time() - start:.1f}s')
+    for project, manifest_db in manifest_databases.items():
+        export_manifest(project, manifest_db)
+    print(f'Snapshots in {snapshot_dir}: {snapshot_size() / 1e9:.2f} GB')
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
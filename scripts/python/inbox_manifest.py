@@ -0,0 +1,247 @@
+"""
+Manifest of what organise_for_inbox.py wrote to the inbox.
+One row per experiment and one per series (file counts and bytes), the compression used for each experiment,
+completeness of each source series (series_stats.py),
+the batch each experiment was moved to by split_inbox_into_batch.py,
+the import status from upload-from-inbox.py and the results of verify_uploads.py.
+MD5 checksums of every file written (the digest XNAT stores in its catalogs) with a roll-up per study.
+"""
+import hashlib
+import sqlite3
+from datetime import datetime
+
+
+#++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
+experiment_schema = """CREATE TABLE IF NOT EXISTS experiments (
+    experiment_id text PRIMARY KEY,
+    project_id text NOT NULL,
+    subject_id text NOT NULL,
+    study_uid text NOT NULL,
+    modality text,
+    session_path text NOT NULL,
+    n_files integer NOT NULL,
+    n_bytes integer NOT NULL,
+    organised_at text
+    );"""
+
+series_schema = """CREATE TABLE IF NOT EXISTS series (
+    experiment_id text NOT NULL,
+    series_uid text NOT NULL,
+    n_files integer NOT NULL,
+    n_bytes integer NOT NULL,
+    PRIMARY KEY (experiment_id, series_uid)
+    );"""
+
+## Source-series completeness from the scanner's header fields (see series_stats.py)
+completeness_schema = """CREATE TABLE IF NOT EXISTS series_completeness (
+    experiment_id text NOT NULL,
+    series_uid text NOT NULL,
+    status text NOT NULL,
+    n_instances integer,
+    min_instance integer,
+    max_instance integer,
+    n_missing integer,
+    n_duplicates integer,
+    PRIMARY KEY (experiment_id, series_uid)
+    );"""
+
+## Size of the source files vs what was written, and CPU time spent writing (compressed or not)
+compression_schema = """CREATE TABLE IF NOT EXISTS compression (
+    experiment_id text PRIMARY KEY,
+    project_id text NOT NULL,
+    modality text,
+    compressor text NOT NULL,
+    transfer_syntax text,
+    n_files integer NOT NULL,
+    source_bytes integer NOT NULL,
+    written_bytes integer NOT NULL,
+    cpu_seconds real NOT NULL
+    );"""
+
+checksum_schema = """CREATE TABLE IF NOT EXISTS file_checksums (
+    experiment_id text NOT NULL,
+    filename text NOT NULL,
+    series_uid text NOT NULL,
+    n_bytes integer NOT NULL,
+    md5 text NOT NULL,
+    PRIMARY KEY (experiment_id, filename)
+    );"""
+
+## One digest over every file checksum in an experiment (see rollup_digest)
+study_checksum_schema = """CREATE TABLE IF NOT EXISTS study_checksums (
+    experiment_id text PRIMARY KEY,
+    study_uid text NOT NULL,
+    n_files integer NOT NULL,
+    digest text NOT NULL
+    );"""
+
+verification_schema = """CREATE TABLE IF NOT EXISTS verification (
+    experiment_id text PRIMARY KEY,
+    project_id text NOT NULL,
+    status text NOT NULL,
+    expected_files integer,
+    found_files integer,
+    details text,
+    verified_at text
+    );"""
+
+upload_schema = """CREATE TABLE IF NOT EXISTS upload_status (
+    experiment_id text PRIMARY KEY,
+    project_id text NOT NULL,
+    status_code text,
+    attempts integer,
+    elapsed real,
+    uploaded_at text
+    );"""
+
+batch_schema = """CREATE TABLE IF NOT EXISTS batches (
+    experiment_id text PRIMARY KEY,
+    project_id text NOT NULL,
+    batch text NOT NULL,
+    n_files integer,
+    n_bytes integer,
+    moved integer NOT NULL DEFAULT 0
+    );"""
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def init_manifest(db_file):
+    conn = sqlite3.connect(db_file, timeout=60)
+    cursor = conn.cursor()
+    for schema in [experiment_schema, series_schema, completeness_schema, compression_schema, checksum_schema,
+                   study_checksum_schema, verification_schema, upload_schema, batch_schema]:
+        cursor.execute(schema)
+    ## Manifests made before the written transfer syntax was recorded
+    if 'transfer_syntax' not in [x[1] for x in cursor.execute("PRAGMA table_info(compression)")]:
+        cursor.execute("ALTER TABLE compression ADD COLUMN transfer_syntax text")
+    conn.commit()
+    return conn
+
+def record_experiment(conn, project, experiment_id, subject_id, study_uid, modality, session_path, series_counts):
+    """
+    series_counts: {series_uid: (n_files, n_bytes)} for the files written to session_path
+    """
+    n_files = sum(x[0] for x in series_counts.values())
+    n_bytes = sum(x[1] for x in series_counts.values())
+    conn.execute("""INSERT OR REPLACE INTO experiments
+                    (experiment_id, project_id, subject_id, study_uid, modality, session_path, n_files, n_bytes, organised_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (experiment_id, project, subject_id, study_uid, modality, session_path, n_files, n_bytes,
+                  datetime.now().isoformat()))
+    conn.execute("DELETE FROM series WHERE experiment_id = ?", (experiment_id,))
+    conn.executemany("INSERT INTO series (experiment_id, series_uid, n_files, n_bytes) VALUES (?, ?, ?, ?)",
+                     [(experiment_id, uid, n, b) for uid, (n, b) in series_counts.items()])
+    conn.commit()
+
+def get_experiments(conn, project):
+    ## {experiment_id: {'subject_id': .., 'n_files': .., 'n_bytes': ..}}
+    rows = conn.execute("SELECT experiment_id, subject_id, n_files, n_bytes FROM experiments WHERE project_id = ?",
+                        (project,)).fetchall()
+    return {e: {'subject_id': s, 'n_files': n, 'n_bytes': b} for e, s, n, b in rows}
+
+def get_series_counts(conn, experiment_id):
+    rows = conn.execute("SELECT series_uid, n_files FROM series WHERE experiment_id = ?", (experiment_id,)).fetchall()
+    return {k: v for k, v in rows}
+
+def record_completeness(conn, experiment_id, stats):
+    ## stats: {series_uid: series_stats.compute_stats(...)} for the series in an experiment
+    conn.execute("DELETE FROM series_completeness WHERE experiment_id = ?", (experiment_id,))
+    conn.executemany("""INSERT INTO series_completeness
+                        (experiment_id, series_uid, status, n_instances, min_instance, max_instance, n_missing, n_duplicates)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                     [(experiment_id, uid, x['status'], x['n_instances'], x['min_instance'], x['max_instance'],
+                       x['n_missing'], x['n_duplicates']) for uid, x in stats.items()])
+    conn.commit()
+
+def get_incomplete_series(conn, experiment_id):
+    ## {series_uid: {'status': .., 'n_missing': .., 'n_duplicates': ..}} for series flagged as broken at the source
+    rows = conn.execute("""SELECT series_uid, status, n_missing, n_duplicates FROM series_completeness
+                           WHERE experiment_id = ? AND status NOT IN ('ok', 'unknown')""", (experiment_id,)).fetchall()
+    return {k: {'status': s, 'n_missing': m, 'n_duplicates': d} for k, s, m, d in rows}
+
+def record_compression(conn, project, experiment_id, modality, compressor, transfer_syntax, n_files, source_bytes,
+                       written_bytes, cpu_seconds):
+    ## compressor is what was configured, transfer_syntax the UID read back from a written file
+    conn.execute("""INSERT OR REPLACE INTO compression
+                    (experiment_id, project_id, modality, compressor, transfer_syntax, n_files, source_bytes, written_bytes, cpu_seconds)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (experiment_id, project, modality, compressor, transfer_syntax, n_files, source_bytes, written_bytes, cpu_seconds))
+    conn.commit()
+
+def get_compression_report(conn, project):
+    ## {(modality, transfer syntax UID written): {'experiments', 'files', 'ratio', 'cpu_ms_per_file', 'saved_gb'}}
+    rows = conn.execute("""SELECT modality, transfer_syntax, COUNT(*), SUM(n_files), SUM(source_bytes), SUM(written_bytes), SUM(cpu_seconds)
+                           FROM compression WHERE project_id = ? GROUP BY modality, transfer_syntax""", (project,)).fetchall()
+    return {(m, c): {'experiments': e, 'files': n, 'ratio': s / w if w else None,
+                     'cpu_ms_per_file': 1000 * t / n if n else None, 'saved_gb': (s - w) / 1e9}
+            for m, c, e, n, s, w, t in rows}
+
+def rollup_digest(checksums):
+    ## Order-independent digest of a study's files: MD5 over the sorted per-file MD5s
+    return hashlib.md5(''.join(sorted(x[2] for x in checksums.values())).encode()).hexdigest()
+
+def record_checksums(conn, experiment_id, study_uid, checksums):
+    """
+    checksums: {filename: (series_uid, n_bytes, md5)} for the files written to an experiment.
+    Returns the experiment IDs of earlier sessions of the same study with identical content (an unchanged re-export).
+    """
+    digest = rollup_digest(checksums)
+    conn.execute("DELETE FROM file_checksums WHERE experiment_id = ?", (experiment_id,))
+    conn.executemany("""INSERT INTO file_checksums (experiment_id, filename, series_uid, n_bytes, md5)
+                        VALUES (?, ?, ?, ?, ?)""", [(experiment_id, k, *v) for k, v in checksums.items()])
+    conn.execute("""INSERT OR REPLACE INTO study_checksums (experiment_id, study_uid, n_files, digest)
+                    VALUES (?, ?, ?, ?)""", (experiment_id, study_uid, len(checksums), digest))
+    conn.commit()
+    rows = conn.execute("""SELECT experiment_id FROM study_checksums
+                           WHERE study_uid = ? AND digest = ? AND experiment_id != ?""",
+                        (study_uid, digest, experiment_id)).fetchall()
+    return [x for (x,) in rows]
+
+def get_series_checksums(conn, experiment_id):
+    ## {series_uid: sorted [md5]} -- compared with XNAT's file digests by verify_uploads.py
+    checksums = {}
+    for series_uid, md5 in conn.execute("SELECT series_uid, md5 FROM file_checksums WHERE experiment_id = ?", (experiment_id,)):
+        checksums.setdefault(series_uid, []).append(md5)
+    return {k: sorted(v) for k, v in checksums.items()}
+
+def record_verification(conn, project, experiment_id, status, expected_files, found_files, details):
+    conn.execute("""INSERT OR REPLACE INTO verification
+                    (experiment_id, project_id, status, expected_files, found_files, details, verified_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                 (experiment_id, project, status, expected_files, found_files, details, datetime.now().isoformat()))
+
+def record_upload(conn, project, experiment_id, status_code, attempts, elapsed):
+    ## Latest import attempt for an experiment (written by upload-from-inbox.py)
+    conn.execute("""INSERT OR REPLACE INTO upload_status
+                    (experiment_id, project_id, status_code, attempts, elapsed, uploaded_at)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                 (experiment_id, project, str(status_code), attempts, elapsed, datetime.now().isoformat()))
+    conn.commit()
+
+def get_experiments_to_requeue(conn, project):
+    ## Experiments whose last verification found missing or incomplete data
+    rows = conn.execute("""SELECT experiment_id FROM verification
+                           WHERE project_id = ? AND status IN ('missing', 'mismatch', 'checksum_mismatch')""", (project,)).fetchall()
+    return {x for (x,) in rows}
+
+def record_batch(conn, project, batch, experiments):
+    ## experiments: [(experiment_id, n_files, n_bytes)] planned for `batch` (written before anything is moved)
+    conn.executemany("""INSERT OR REPLACE INTO batches (experiment_id, project_id, batch, n_files, n_bytes, moved)
+                        VALUES (?, ?, ?, ?, ?, 0)""", [(e, project, batch, n, b) for e, n, b in experiments])
+    conn.commit()
+
+def mark_moved(conn, project, experiment_ids):
+    conn.executemany("UPDATE batches SET moved = 1 WHERE project_id = ? AND experiment_id = ?",
+                     [(project, e) for e in experiment_ids])
+    conn.commit()
+
+def get_unmoved_batches(conn, project):
+    ## {experiment_id: batch} for moves that were planned but not finished
+    rows = conn.execute("SELECT experiment_id, batch FROM batches WHERE project_id = ? AND moved = 0",
+                        (project,)).fetchall()
+    return {e: b for e, b in rows}
+
+def get_batches(conn, project):
+    ## Names of fully moved batches in numerical order
+    rows = conn.execute("""SELECT batch FROM batches WHERE project_id = ? GROUP BY batch HAVING MIN(moved) = 1""",
+                        (project,)).fetchall()
+    return sorted([x for (x,) in rows], key=lambda x: int(x.split('_')[-1]) if x.split('_')[-1].isdigit() else x)
@@ -0,0 +1,309 @@
+"""
+Lightweight stand-in for the parts of the XNAT REST API used by upload-from-inbox.py and verify_uploads.py.
+
+Implements:
+- GET  /data/projects/{project}/experiments (and /subjects) listings with paging
+- GET  /data/projects/{project}/experiments/{label} and /subjects/{label}/experiments/{label}
+- PUT  /data/projects/{project}/subjects/{label}
+- POST /data/services/import?import-handler=inbox (creating the subject first if it doesn't exist)
+- GET  /xapi/dicom/list/active
+- A DICOM C-STORE SCP (needs pynetdicom) routing files by PatientComments, like XNAT's DICOM receiver
+
+Latency, error injection and import capacity are configurable so the uploader can be benchmarked
+and regression-tested without the docker-compose stack. Run directly to serve on `port`.
+"""
+import os
+import json
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+port = 8080
+scp_port = 8104
+scp_ae_title = 'XNAT'
+## Local directory standing in for /data/xnat/inbox/ on the XNAT container
+inbox_root = './outputs/mock_inbox/'
+
+## Fixed latency for every request (seconds) with +/- jitter
+base_latency = 0.01
+latency_jitter = 0.005
+## Import time is modelled as a fixed cost plus a cost per file in the session
+import_latency = 0.05
+import_seconds_per_file = 0.001
+## Fraction of requests that fail (HTTP 500 / C-STORE 0xA700), per endpoint type
+error_rates = {'listing': 0.0, 'experiment': 0.0, 'import': 0.0, 'active': 0.0, 'c-store': 0.0, 'subject': 0.0}
+## Time taken to store each file received over C-STORE (seconds)
+store_latency = 0.001
+## Extra time an import takes when it has to create its subject (imports for one new subject are serialised)
+subject_create_latency = 0.05
+## Imports XNAT will run at once. Further imports wait up to `import_queue_timeout` seconds for a slot, then get a 503
+max_concurrent_imports = 4
+import_queue_timeout = 30
+
+
+class MockXnat:
+    ## Shared state of the mock server: experiments, subjects and imports in progress
+    def __init__(self, inbox_root=inbox_root, base_latency=base_latency, latency_jitter=latency_jitter,
+                 import_latency=import_latency, import_seconds_per_file=import_seconds_per_file,
+                 error_rates=error_rates, max_concurrent_imports=max_concurrent_imports,
+                 import_queue_timeout=import_queue_timeout, subject_create_latency=subject_create_latency, seed=None):
+        self.inbox_root = inbox_root
+        self.base_latency = base_latency
+        self.latency_jitter = latency_jitter
+        self.import_latency = import_latency
+        self.import_seconds_per_file = import_seconds_per_file
+        self.error_rates = dict(error_rates)
+        self.import_slots = threading.BoundedSemaphore(max_concurrent_imports)
+        self.import_queue_timeout = import_queue_timeout
+        self.subject_create_latency = subject_create_latency
+        self.subject_lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.experiments = {} # (project, label): experiment dict
+        self.subjects = {} # (project, label): subject dict
+        self.active = {} # import id: active import dict
+        self.counter = 0
+        self.request_counts = {}
+
+    def next_id(self, prefix):
+        with self.lock:
+            self.counter += 1
+            return f'{prefix}{self.counter:08d}'
+
+    def delay(self, seconds=0.0):
+        with self.lock:
+            jitter = self.random.uniform(-self.latency_jitter, self.latency_jitter)
+        time.sleep(max(0.0, self.base_latency + jitter + seconds))
+
+    def should_fail(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+            return self.random.random() < self.error_rates.get(endpoint, 0.0)
+
+    def add_subject(self, project, label):
+        with self.lock:
+            key = (project, label)
+            if key not in self.subjects:
+                self.counter += 1
+                self.subjects[key] = {'ID': f'XNAT_S{self.counter:08d}', 'label': label, 'project': project,
+                                      'last_modified': now()}
+            return self.subjects[key]
+
+    def add_experiment(self, project, subject_label, label, scans):
+        subject = self.add_subject(project, subject_label)
+        experiment_id = self.next_id('XNAT_E')
+        with self.lock:
+            self.experiments[(project, label)] = {
+                'ID': experiment_id, 'label': label, 'project': project, 'subject_ID': subject['ID'],
+                'subject_label': subject_label, 'last_modified': now(), 'scans': scans}
+        return experiment_id
+
+    def import_session(self, params):
+        project = params['PROJECT_ID']
+        subject_label = params['SUBJECT_ID']
+        label = params['EXPT_LABEL']
+        local_path = params['path'].replace('/data/xnat/inbox/', self.inbox_root, 1)
+        if not os.path.isdir(local_path):
+            return 400, f'Path not found: {params["path"]}'
+        files = os.listdir(local_path)
+        if not files:
+            return 400, f'No files found in {params["path"]}'
+
+        if not self.import_slots.acquire(timeout=self.import_queue_timeout):
+            return 503, 'Too many imports in progress'
+        try:
+            import_id = self.next_id('import_')
+            with self.lock:
+                self.active[import_id] = {'id': import_id, 'project': project, 'subject': subject_label,
+                                          'session': label, 'fileCount': len(files), 'started': now()}
+            with self.subject_lock:
+                if (project, subject_label) not in self.subjects:
+                    self.request_counts['inline_subject'] = self.request_counts.get('inline_subject', 0) + 1
+                    time.sleep(self.subject_create_latency)
+                    self.add_subject(project, subject_label)
+            self.delay(self.import_latency + self.import_seconds_per_file * len(files))
+            ## Whole session goes into a single scan -- the mock doesn't read headers
+            scans = [{'ID': '1', 'UID': label, 'file_count': len(files)}]
+            self.add_experiment(project, subject_label, label, scans)
+        finally:
+            with self.lock:
+                self.active.pop(import_id, None)
+            self.import_slots.release()
+        return 200, f'/archive/projects/{project}/subjects/{subject_label}/experiments/{label}'
+
+    def receive_instance(self, project, subject_label, label, series_uid):
+        ## One file received by the SCP: add it to the experiment/scan, creating them as needed
+        subject = self.add_subject(project, subject_label)
+        with self.lock:
+            experiment = self.experiments.get((project, label))
+            if experiment is None:
+                self.counter += 1
+                experiment = {'ID': f'XNAT_E{self.counter:08d}', 'label': label, 'project': project,
+                              'subject_ID': subject['ID'], 'subject_label': subject_label, 'scans': []}
+                self.experiments[(project, label)] = experiment
+            experiment['last_modified'] = now()
+            scan = next((x for x in experiment['scans'] if x['UID'] == series_uid), None)
+            if scan is None:
+                scan = {'ID': str(len(experiment['scans']) + 1), 'UID': series_uid, 'file_count': 0}
+                experiment['scans'].append(scan)
+            scan['file_count'] += 1
+            self.request_counts['c-store'] = self.request_counts.get('c-store', 0) + 1
+
+    def listing(self, project, table, params):
+        items = self.experiments if table == 'experiments' else self.subjects
+        with self.lock:
+            rows = [{k: v for k, v in x.items() if k != 'scans'} for (p, _), x in items.items() if p == project]
+        rows.sort(key=lambda x: x['last_modified'])
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', len(rows) or 1))
+        rows = rows[offset:offset + limit]
+        return {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+
+    def experiment_document(self, project, label):
+        with self.lock:
+            experiment = self.experiments.get((project, label))
+        if experiment is None:
+            return None
+        scans = [{'field': 'scans/scan', 'items': [
+            {'data_fields': {'ID': scan['ID'], 'UID': scan['UID']},
+             'children': [{'field': 'file', 'items': [
+                 {'data_fields': {'label': 'DICOM', 'file_count': scan['file_count']}}]}]}
+            for scan in experiment['scans']]}]
+        data_fields = {'ID': experiment['ID'], 'label': label, 'project': project,
+                       'subject_ID': experiment['subject_ID']}
+        return {'items': [{'data_fields': data_fields, 'children': scans}]}
+
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def make_handler(xnat):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, body):
+            data = (json.dumps(body) if not isinstance(body, str) else body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json' if not isinstance(body, str) else 'text/plain')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self):
+            parsed = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            parts = [x for x in parsed.path.split('/') if x]
+            return parts, params
+
+        def do_GET(self):
+            parts, params = self.route()
+            if parts == ['xapi', 'dicom', 'list', 'active']:
+                endpoint = 'active'
+            elif len(parts) == 4 and parts[:2] == ['data', 'projects'] and parts[3] in ('experiments', 'subjects'):
+                endpoint = 'listing'
+            elif parts[:2] == ['data', 'projects'] and 'experiments' in parts[3:-1]:
+                endpoint = 'experiment'
+            else:
+                return self.send(404, 'Not found')
+
+            fail = xnat.should_fail(endpoint)
+            xnat.delay()
+            if fail:
+                return self.send(500, 'Injected error')
+            if endpoint == 'active':
+                with xnat.lock:
+                    return self.send(200, list(xnat.active.values()))
+            if endpoint == 'listing':
+                return self.send(200, xnat.listing(parts[2], parts[3], params))
+            document = xnat.experiment_document(parts[2], parts[-1])
+            if document is None:
+                return self.send(404, 'Experiment not found')
+            return self.send(200, document)
+
+        def do_PUT(self):
+            parts, params = self.route()
+            if len(parts) != 5 or parts[:2] != ['data', 'projects'] or parts[3] != 'subjects':
+                return self.send(404, 'Not found')
+            fail = xnat.should_fail('subject')
+            xnat.delay()
+            if fail:
+                return self.send(500, 'Injected error')
+            with xnat.lock:
+                exists = (parts[2], parts[4]) in xnat.subjects
+            subject = xnat.add_subject(parts[2], parts[4])
+            return self.send(200 if exists else 201, subject['ID'])
+
+        def do_POST(self):
+            parts, params = self.route()
+            if parts != ['data', 'services', 'import'] or params.get('import-handler') != 'inbox':
+                return self.send(404, 'Not found')
+            if xnat.should_fail('import'):
+                xnat.delay()
+                return self.send(500, 'Injected error')
+            status, body = xnat.import_session(params)
+            return self.send(status, body)
+
+    return Handler
+
+def start_server(xnat=None, port=0):
+    ## Start the mock in a background thread. port=0 picks a free port -- use server.server_address to find it
+    xnat = xnat if xnat is not None else MockXnat()
+    server = ThreadingHTTPServer(('localhost', port), make_handler(xnat))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, xnat
+
+def parse_routing(comment):
+    ## 'Project: P Subject: S Session: E' -> {'Project': 'P', 'Subject': 'S', 'Session': 'E'}
+    words = str(comment or '').replace(':', ': ').split()
+    return {k.rstrip(':'): v for k, v in zip(words, words[1:]) if k.endswith(':')}
+
+def start_scp(xnat=None, port=0, ae_title=scp_ae_title, transfer_syntaxes=None, store_latency=store_latency):
+    """
+    Start a C-STORE SCP in a background thread, adding received files to `xnat` (so verify_uploads.py can check them).
+    transfer_syntaxes: syntaxes to accept for every storage SOP class (default: all pynetdicom knows)
+    Returns (server, xnat) -- server.server_address has the port, server.shutdown() stops it.
+    """
+    from pynetdicom import AE, evt, AllStoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+    xnat = xnat if xnat is not None else MockXnat()
+    ae = AE(ae_title=ae_title)
+    for cx in AllStoragePresentationContexts:
+        ae.add_supported_context(cx.abstract_syntax, transfer_syntaxes or ALL_TRANSFER_SYNTAXES)
+
+    def handle_store(event):
+        ds = event.dataset
+        routing = parse_routing(ds.get('PatientComments'))
+        if not {'Project', 'Subject', 'Session'} <= set(routing) or xnat.should_fail('c-store'):
+            return 0xA700 # Out of resources -- what XNAT returns when it can't route the file
+        time.sleep(store_latency)
+        xnat.receive_instance(routing['Project'], routing['Subject'], routing['Session'], str(ds.SeriesInstanceUID))
+        return 0x0000
+
+    server = ae.start_server(('localhost', port), block=False, evt_handlers=[(evt.EVT_C_STORE, handle_store)])
+    return server, xnat
+
+def main():
+    server, xnat = start_server(port=port)
+    print(f'Mock XNAT serving {inbox_root} on http://localhost:{server.server_address[1]}')
+    try:
+        scp, _ = start_scp(xnat, port=scp_port)
+        print(f'Mock DICOM receiver {scp_ae_title} on localhost:{scp.server_address[1]}')
+    except ImportError:
+        scp = None
+        print('pynetdicom not installed: C-STORE receiver not started')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        if scp is not None:
+            scp.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Script for monitoring XNAT imports over time (a time-series version of ../shell/query-dicom-uploads.sh).
+
+Every `poll_interval` seconds it records the active DICOM imports, the prearchive queue for the project
+and the number of experiments in the project into a local SQLite table.
+Experiments are counted in the local XNAT cache (xnat_cache.py), refreshed incrementally, so each poll only
+requests the experiments modified since the last one. Requests that fail are recorded as NULLs.
+Every `report_every` samples it prints files/sec, sessions/hour and the queue-depth trend,
+which can be used to size XNAT heap and uploader concurrency.
+"""
+import os
+import sqlite3
+import time
+from datetime import datetime
+import requests
+import xnat_cache
+import xnat_session
+
+PROJECT = 'STAMPEDE-AG'
+url = 'http://localhost:80'
+monitor_filename = f'./outputs/audit/monitor_{PROJECT}.db'
+## Inbox manifest -- file counts of the experiments XNAT has archived
+manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
+## Local cache of the project's experiments (shared with upload-from-inbox.py)
+cache_filename = './outputs/xnat_cache.db'
+
+poll_interval = 60 # seconds
+report_every = 10 # samples
+## Window (seconds) rates and trends are computed over
+report_window = 3600
+
+sample_schema = """CREATE TABLE IF NOT EXISTS samples (
+    ts real PRIMARY KEY,
+    active_imports integer,
+    active_files integer,
+    prearchive_sessions integer,
+    experiment_count integer,
+    files_archived integer
+    );"""
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def init_db(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.execute(sample_schema)
+    conn.commit()
+    return conn
+
+def get_active_imports(sess):
+    res = sess.get(f"{url}/xapi/dicom/list/active")
+    if res.status_code != 200:
+        return None, None
+    active = res.json()
+    if isinstance(active, dict):
+        active = next((v for v in active.values() if isinstance(v, list)), [])
+    ## Not every XNAT version reports a file count for each import
+    files = sum(int(x.get('fileCount', 0) or 0) for x in active if isinstance(x, dict))
+    return len(active), files
+
+def get_prearchive_sessions(sess):
+    res = sess.get(f"{url}/data/prearchive/projects/{PROJECT}", params={'format': 'json'})
+    if res.status_code != 200:
+        return None
+    return len(res.json()['ResultSet']['Result'])
+
+def refresh_experiments(cache_conn, sess):
+    ## Labels of the experiments XNAT lists in the project (archived sessions only)
+    try:
+        xnat_cache.refresh_listing(cache_conn, sess, url, PROJECT, 'experiments')
+    except Exception:
+        cache_conn.rollback() # Don't keep the uploader locked out of the cache until the next poll
+        raise
+    return xnat_cache.get_experiment_labels(cache_conn, PROJECT)
+
+def get_files_archived(archived):
+    ## Files written by organise for the experiments XNAT has archived
+    if not os.path.exists(manifest_filename):
+        return None
+    with sqlite3.connect(manifest_filename, timeout=60) as conn:
+        rows = conn.execute("SELECT experiment_id, n_files FROM experiments WHERE project_id = ?", (PROJECT,)).fetchall()
+    return sum(n_files or 0 for experiment_id, n_files in rows if experiment_id in archived)
+
+def poll(fn, *args, default=None):
+    ## A failed request or unexpected reply is recorded as NULL rather than stopping the monitor
+    try:
+        return fn(*args)
+    except (requests.RequestException, sqlite3.OperationalError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f'{fn.__name__} failed: {e!r}')
+        return default
+
+def take_sample(conn, cache_conn, sess):
+    active_imports, active_files = poll(get_active_imports, sess, default=(None, None))
+    archived = poll(refresh_experiments, cache_conn, sess)
+    sample = (time.time(), active_imports, active_files, poll(get_prearchive_sessions, sess),
+              None if archived is None else len(archived), None if archived is None else get_files_archived(archived))
+    conn.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?)", sample)
+    conn.commit()
+    return sample
+
+def rate(samples, column):
+    ## Change per second of a cumulative column between the first and last sample it was recorded in
+    points = [(s[0], s[column]) for s in samples if s[column] is not None]
+    if len(points) < 2 or points[-1][0] == points[0][0]:
+        return None
+    return (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0])
+
+def slope(samples, column):
+    ## Least-squares trend (change per hour) of a gauge such as queue depth
+    points = [(s[0], s[column]) for s in samples if s[column] is not None]
+    if len(points) < 2:
+        return None
+    mean_t = sum(t for t, _ in points) / len(points)
+    mean_v = sum(v for _, v in points) / len(points)
+    var = sum((t - mean_t) ** 2 for t, _ in points)
+    if var == 0:
+        return None
+    return 3600 * sum((t - mean_t) * (v - mean_v) for t, v in points) / var
+
+def summarise(conn, window=report_window):
+    samples = conn.execute("SELECT * FROM samples WHERE ts >= ? ORDER BY ts", (time.time() - window,)).fetchall()
+    if not samples:
+        return {}
+    queue_depth = [(s[0], (s[1] or 0) + (s[3] or 0)) for s in samples]
+    files_per_sec = rate(samples, 5)
+    sessions_per_sec = rate(samples, 4)
+    summary = {
+        'samples': len(samples),
+        'files_per_sec': files_per_sec,
+        'sessions_per_hour': None if sessions_per_sec is None else 3600 * sessions_per_sec,
+        'active_imports': samples[-1][1],
+        'prearchive_sessions': samples[-1][3],
+        'queue_depth_trend_per_hour': slope(queue_depth, 1),
+    }
+    return summary
+
+def main():
+    conn = init_db(monitor_filename)
+    cache_conn = xnat_cache.init_cache(cache_filename)
+    with xnat_session.create_session(pool_size=1) as sess:
+        n = 0
+        while True:
+            sample = take_sample(conn, cache_conn, sess)
+            n += 1
+            print(f"{datetime.now().strftime('%H:%M:%S')} active: {sample[1]} ({sample[2]} files), "
+                  f"prearchive: {sample[3]}, experiments: {sample[4]}")
+            if n % report_every == 0:
+                print(f"----- Last {report_window // 60} min: {summarise(conn)} -----")
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    main()
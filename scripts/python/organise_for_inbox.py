@@ -2,15 +2,25 @@
 Script for reading database and organising into directories for every study
 
 Updated for better error handling.
+Optionally writes the inbox files losslessly compressed (compressor chosen per modality) using several worker processes.
 
 After running this, run upload-from-inbox.py
 """
 import os
+import hashlib
 import sqlite3
+import time
+import multiprocessing
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import SimpleITK as sitk
 import polars as pl
+import pydicom
+import archive_io
+import inbox_manifest
+import series_stats
+import tracing
 
 
 PROJECT='STAMPEDE-AG' # Project ID from XNAT 
@@ -21,8 +31,31 @@ data_mount_directory = '/mnt/j/'
 
 
 error_filename= f'./logs/ERRORS-{trial_arm}-organise-for-inbox-{datetime.now().strftime("%Y-%m-%d--%H:%M")}.db'
+## Record of experiments/series written to the inbox (used by verify_uploads.py)
+manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
 target_dir = '/mnt/d/xnat/1.8/inbox/'#'/mnt/h/ACE_batches' ## /mnt/h/AG_batches
 
+## Lossless compression for the files written to the inbox. SimpleITK's GDCMImageIO only knows two compressors:
+## 'JPEG' (JPEG Lossless, Process 14 SV1 -- 1.2.840.10008.1.2.4.70) and 'JPEG2000' (JPEG 2000 Lossless -- .4.90);
+## any other name is silently written as JPEG 2000, so names are checked at startup.
+## The transfer syntax actually written is read back from the output and stored in the manifest.
+## Modalities not listed use compressors['default']; None writes uncompressed (the original behaviour).
+compress_output = False
+supported_compressors = ('JPEG', 'JPEG2000')
+compressors = {'CT': 'JPEG2000', 'MR': 'JPEG2000', 'PT': 'JPEG', 'NM': 'JPEG', 'default': 'JPEG'}
+## Slices scanned inside zip/tar archives (archive_io.py) are copied here one at a time for SimpleITK to read
+member_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+## MD5 of every file written, stored in the manifest (file_checksums/study_checksums)
+record_checksums = True
+## Only organise these patient IDs / study UIDs (as stored in dicomdb). None = every study in the audit DB.
+target_patients = None
+target_studies = None
+## Studies organised at once (each in its own process)
+organise_workers = 1
+## Module settings copied into the worker processes (spawned, so overrides made by pipeline.py/benchmarks aren't inherited)
+worker_settings = ['PROJECT', 'db_filename', 'trial_arm', 'data_mount_directory', 'error_filename', 'manifest_filename',
+                   'target_dir', 'compress_output', 'compressors', 'member_tmp_dir', 'record_checksums']
+
 #path_to_csv = '/mnt/d/xnat/XNAT-STAMPEDE/csv/AJ_altID_to_trialID_trimmed.csv' #AltID to trial ID conversion
 path_to_csv = '/mnt/d/patientID_to_trialNo.csv'
 
@@ -79,7 +112,7 @@ def create_connection(db_file):
     print(f'Starting connection to {db_file}')
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, timeout=60)
     except sqlite3.Error as e:
         print(e)
     return conn
@@ -91,22 +124,36 @@ def create_table(conn, schema):
     except sqlite3.Error as e:
         print(e)
 
-def process_study(subset, session_path, subject_id, **kwargs):
-    filepaths = subset.select("filepath").to_series().to_list()
+def process_study(subset, session_path, subject_id, experiment_id=None, modality=None, **kwargs):
+    files = subset.select("filepath", "series_uid").rows()
     study_uid = subset.select("study_uid").unique().item()
-    for filepath in tqdm(filepaths, position=1, leave=False):
+    series_counts = {} # series_uid: (files written, bytes written) -- for the manifest
+    compressor = get_compressor(modality)
+    source_bytes, cpu_seconds = 0, 0.0
+    transfer_syntax = None
+    checksums = {} # filename: (series_uid, bytes, md5)
+    for filepath, series_uid in tqdm(files, position=1, leave=False):
         filepath = filepath.replace('/mnt/d/', data_mount_directory)
         filename = os.path.basename(filepath)
-        slice_ = load_slice(filepath, subject_id, study_uid)
+        with tracing.span('read_slice'), archive_io.local_file(filepath, member_tmp_dir) as local_path:
+            slice_ = load_slice(local_path, subject_id, study_uid)
         if slice_ is None:
             print("Can't load slice")
             continue # Catch if error loading slice
         # Write slice with updated metadata 
         writer = sitk.ImageFileWriter()
         writer.KeepOriginalImageUIDOn()
-        writer.SetFileName(os.path.join(session_path, filename))
+        if compressor is not None:
+            writer.SetImageIO('GDCMImageIO')
+            writer.UseCompressionOn()
+            writer.SetCompressor(compressor)
+        output_path = os.path.join(session_path, filename)
+        writer.SetFileName(output_path)
         try:
-            writer.Execute(slice_)
+            cpu_start = time.process_time()
+            with tracing.span('write_slice'):
+                writer.Execute(slice_)
+            cpu_seconds += time.process_time() - cpu_start
         except Exception as e:
             error = {'subject_id': subject_id, 'study_uid': study_uid, 'error': str(e)}
             columns = ', '.join(error.keys())
@@ -115,6 +162,67 @@ def process_study(subset, session_path, subject_id, **kwargs):
             err_cursor.execute(sql, error)
             err.commit()
             continue
+        if transfer_syntax is None:
+            transfer_syntax = written_transfer_syntax(output_path)
+        if record_checksums:
+            size, md5 = checksum_file(output_path)
+            checksums[filename] = (series_uid, size, md5)
+        else:
+            size = os.path.getsize(output_path)
+        n_files, n_bytes = series_counts.get(series_uid, (0, 0))
+        series_counts[series_uid] = (n_files + 1, n_bytes + size)
+        source_bytes += archive_io.file_size(filepath)
+
+    if experiment_id is not None:
+        inbox_manifest.record_experiment(manifest, PROJECT, experiment_id, subject_id, study_uid, modality,
+                                         session_path, series_counts)
+        record_completeness(subset, experiment_id)
+        inbox_manifest.record_compression(manifest, PROJECT, experiment_id, modality, compressor or 'none', transfer_syntax,
+                                          sum(x[0] for x in series_counts.values()), source_bytes,
+                                          sum(x[1] for x in series_counts.values()), cpu_seconds)
+        if record_checksums:
+            unchanged = inbox_manifest.record_checksums(manifest, experiment_id, study_uid, checksums)
+            if unchanged:
+                print(f'{experiment_id} has the same content as {unchanged} (unchanged re-export)')
+
+def checksum_file(path, chunk_size=1024**2):
+    ## (size, md5) of a file that has just been written -- it's still in the page cache, so this doesn't touch the disk
+    md5 = hashlib.md5()
+    size = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+            size += len(chunk)
+    return size, md5.hexdigest()
+
+def written_transfer_syntax(path):
+    ## Transfer syntax UID in the header of a file we've just written
+    return str(pydicom.dcmread(path, stop_before_pixels=True).file_meta.TransferSyntaxUID)
+
+def transfer_syntax_name(uid):
+    return 'none written' if uid is None else pydicom.uid.UID(uid).name
+
+def check_compressors():
+    unknown = {x for x in compressors.values() if x is not None} - set(supported_compressors)
+    if compress_output and unknown:
+        raise ValueError(f'Unsupported compressors {sorted(unknown)} -- SimpleITK supports {supported_compressors}')
+
+def get_compressor(modality):
+    if not compress_output:
+        return None
+    return compressors.get(modality, compressors.get('default'))
+
+def record_completeness(subset, experiment_id):
+    ## Flag series that were already incomplete in the source, using the header fields in the audit DB (no extra reads)
+    if 'instance_number' not in subset.columns:
+        return # Audit DB made by an older scanner
+    rows = subset.select("series_uid", "instance_number", "image_position", "number_of_frames").rows()
+    stats = series_stats.stats_by_series(rows)
+    for series_uid, x in stats.items():
+        if series_stats.is_broken(x):
+            print(f"{experiment_id}: series {series_uid} is {x['status']} in the source "
+                  f"(instances {x['min_instance']}-{x['max_instance']}, {x['n_missing']} missing, {x['n_duplicates']} duplicated)")
+    inbox_manifest.record_completeness(manifest, experiment_id, stats)
 
 
 def load_slice(path, trial_id, study_uid):
@@ -142,139 +250,220 @@ def load_slice(path, trial_id, study_uid):
     slice_.SetMetaData('0010|0020', trial_id) # Patient ID
     return slice_
 
-def main():
-    global err, err_cursor
+def init_outputs():
+    global err, err_cursor, manifest
     # Make db for catching errors + POST response status
+    ## Shared by every organise worker -- WAL and a long busy timeout so concurrent commits wait rather than fail
     err = create_connection(error_filename)
+    err.execute('PRAGMA journal_mode=WAL')
     err_cursor = err.cursor()
     create_table(err, error_schema)
     create_table(err, upload_schema)
+    manifest = inbox_manifest.init_manifest(manifest_filename)
 
+def load_id_mapping():
     ## Load trial ID <-> altID csv
     if trial_arm == 'AJ':
-        id_df = pl.read_csv(path_to_csv, dtypes={'patient_id': str, 'trialno':str})
-    else:
-        id_df = None
+        return pl.read_csv(path_to_csv, dtypes={'patient_id': str, 'trialno':str})
+    return None
 
-    os.makedirs(os.path.join(target_dir, PROJECT), exist_ok=True)    
+def organise_study(subset, row, id_df, empty_dirs=(), non_empty_dirs=()):
+    """
+    Work out the experiment ID for one study and write its slices to the inbox.
+    Returns the experiment ID if the session is in the inbox (written now or by a previous run), None on error.
+    """
+    try:
+        patID = subset.select("patient_id").unique().item()
+    except ValueError:
+        print(f'Too many patient IDs??: {subset.select("patient_id").unique()}')
+        error = {'subject_id': f"{subset.select('patient_id').unique()}", 'study_uid': row['study_uid'], 'error': f'Too many patient IDs: {subset.select("patient_id").unique()} -- study_date: {subset.select("study_date").unique()}'}
+        columns = ', '.join(error.keys())
+        placeholders = ':'+', :'.join(error.keys())
+        sql = """INSERT INTO errors (%s) VALUES (%s)""" % (columns, placeholders)
+        err_cursor.execute(sql, error)
+        err.commit()
+        return
     
-    empty_dirs, non_empty_dirs = scan_for_empty_directories(os.path.join(target_dir, PROJECT))
-    print(f'Found {len(empty_dirs)} empty directories and {len(non_empty_dirs)} non-empty directories.')
-    print(empty_dirs)
-    #exit()
-    # Connect to imaging database
-    global df
-    conn = create_connection(db_filename)
-    df = pl.read_database("SELECT * from dicomdb", conn)
-    #df = pl.read_csv('./outputs/audit/debugging_AltID892.csv')#csv_filename)
+    # Remove whitespace
+    patID = patID.strip()
 
-    num_patients = df.select("patient_id").n_unique()
-    # Group by study UID
-    # Don't do by series UID otherwise XNAT groups everything by series.
-    groups = df.unique("study_uid", maintain_order=True)
-    print(f"{num_patients} patient(s) with {len(groups)} studies to process")
-
-    for row in tqdm(groups.rows(named=True), position=0):
-        subset = df.filter(pl.col("study_uid") == row['study_uid'])
+    if trial_arm == 'AJ':
+        assert 'AltID' in patID
+        #altID = int(patID.lstrip('AltID'))
+        print(f'Reading {patID}')
         try:
-            patID = subset.select("patient_id").unique().item()
-        except ValueError:
-            print(f'Too many patient IDs??: {subset.select("patient_id").unique()}')
-            error = {'subject_id': f"{subset.select('patient_id').unique()}", 'study_uid': row['study_uid'], 'error': f'Too many patient IDs: {subset.select("patient_id").unique()} -- study_date: {subset.select("study_date").unique()}'}
+            trial_id = str(id_df.filter(pl.col("patient_id")== str(patID)).select("trialno").item())
+        except ValueError as e:
+            print(f"Couldn't find matching trial ID for {patID}. Row: {row}")
+
+            error = {'subject_id': patID, 'study_uid': row['study_uid'], 'error': str(e)}
             columns = ', '.join(error.keys())
             placeholders = ':'+', :'.join(error.keys())
             sql = """INSERT INTO errors (%s) VALUES (%s)""" % (columns, placeholders)
             err_cursor.execute(sql, error)
             err.commit()
-            continue
-        
-        # Remove whitespace
-        patID = patID.strip()
-
-        if trial_arm == 'AJ':
-            assert 'AltID' in patID
-            #altID = int(patID.lstrip('AltID'))
-            print(f'Reading {patID}')
-            try:
-                trial_id = str(id_df.filter(pl.col("patient_id")== str(patID)).select("trialno").item())
-            except ValueError as e:
-                print(f"Couldn't find matching trial ID for {patID}. Row: {row}")
-
-                error = {'subject_id': patID, 'study_uid': row['study_uid'], 'error': str(e)}
-                columns = ', '.join(error.keys())
-                placeholders = ':'+', :'.join(error.keys())
-                sql = """INSERT INTO errors (%s) VALUES (%s)""" % (columns, placeholders)
-                err_cursor.execute(sql, error)
-                err.commit()
-                continue
+            return
 
-        else:
-            trial_id = str(patID)
-
-        id_ = subset.select("id")[0].item()
-        modalities = subset.select("modality").unique().to_series().to_list()
-        modalities = [x.strip() for x in modalities if x is not None]
-        
-
-
-
-        if len(modalities) != 1 and 'OT' in modalities:
-            modalities.remove('OT')
-        if len(modalities) != 1 and 'SC' in modalities:
-            modalities.remove('SC')
-        if len(modalities) != 1 and 'SR' in modalities:
-            modalities.remove('SR')
-        if len(modalities) != 1 and 'SD' in modalities:
-            modalities.remove('SD')
-        if len(modalities) != 1 and 'CR' in modalities:
-            modalities.remove('CR')
-        if len(modalities) != 1 and 'RTIMAGE' in modalities:
-            modalities.remove('RTIMAGE')
-        if len(modalities) != 1 and 'SEG' in modalities:
-            modalities.remove('SEG')
-
-        if len(modalities) == 1:
-            modality = modalities[0]
-        elif len(modalities) == 2 and sorted(modalities) == ['CT', 'PT']:
-            modality = 'PT'
-        elif len(modalities) == 2 and sorted(modalities) == ['CT', 'NM']:
-            modality = 'NM'
+    else:
+        trial_id = str(patID)
 
-        else:
-            print(f'Too many modalities detected: {modalities}. {subset}')
-            print(subset['filepath'][:1])
-            error = {'subject_id': patID, 'study_uid': row['study_uid'], 'error': f'Too many modalities detected: {modalities}.'}
-            columns = ', '.join(error.keys())
-            placeholders = ':'+', :'.join(error.keys())
-            sql = """INSERT INTO errors (%s) VALUES (%s)""" % (columns, placeholders)
-            err_cursor.execute(sql, error)
-            err.commit()
-            continue
-        
-        #continue
+    id_ = subset.select("id")[0].item()
+    modalities = subset.select("modality").unique().to_series().to_list()
+    modalities = [x.strip() for x in modalities if x is not None]
+    
 
 
-        # Make output directory
-        experiment_id = f'{trial_id}_{modality}_{id_}'#
 
-        session_path = os.path.join(target_dir, PROJECT, experiment_id)
-        if experiment_id in non_empty_dirs:
-            print(f"{experiment_id} is non-empty directory, skipping")
-            continue
+    if len(modalities) != 1 and 'OT' in modalities:
+        modalities.remove('OT')
+    if len(modalities) != 1 and 'SC' in modalities:
+        modalities.remove('SC')
+    if len(modalities) != 1 and 'SR' in modalities:
+        modalities.remove('SR')
+    if len(modalities) != 1 and 'SD' in modalities:
+        modalities.remove('SD')
+    if len(modalities) != 1 and 'CR' in modalities:
+        modalities.remove('CR')
+    if len(modalities) != 1 and 'RTIMAGE' in modalities:
+        modalities.remove('RTIMAGE')
+    if len(modalities) != 1 and 'SEG' in modalities:
+        modalities.remove('SEG')
+
+    if len(modalities) == 1:
+        modality = modalities[0]
+    elif len(modalities) == 2 and sorted(modalities) == ['CT', 'PT']:
+        modality = 'PT'
+    elif len(modalities) == 2 and sorted(modalities) == ['CT', 'NM']:
+        modality = 'NM'
+
+    else:
+        print(f'Too many modalities detected: {modalities}. {subset}')
+        print(subset['filepath'][:1])
+        error = {'subject_id': patID, 'study_uid': row['study_uid'], 'error': f'Too many modalities detected: {modalities}.'}
+        columns = ', '.join(error.keys())
+        placeholders = ':'+', :'.join(error.keys())
+        sql = """INSERT INTO errors (%s) VALUES (%s)""" % (columns, placeholders)
+        err_cursor.execute(sql, error)
+        err.commit()
+        return
 
-        if experiment_id in empty_dirs:
-            print(f'Attempting to process and empty directory: {experiment_id}')
 
-        if os.path.isdir(session_path):
-            print(f'{session_path} already processed, skipping')
-            continue
-        
-        params= {'subset': subset, 'session_path': session_path, 'subject_id': trial_id, 'experiment_id': experiment_id}
-        print(f'Processing: {params}')
-        os.makedirs(params['session_path'], exist_ok=True)
-        process_study(**params)
+    # Make output directory
+    experiment_id = f'{trial_id}_{modality}_{id_}'#
+
+    session_path = os.path.join(target_dir, PROJECT, experiment_id)
+    if experiment_id in non_empty_dirs:
+        print(f"{experiment_id} is non-empty directory, skipping")
+        return experiment_id
+
+    if experiment_id in empty_dirs:
+        print(f'Attempting to process and empty directory: {experiment_id}')
+
+    if os.path.isdir(session_path):
+        print(f'{session_path} already processed, skipping')
+        return experiment_id
+    
+    params= {'subset': subset, 'session_path': session_path, 'subject_id': trial_id, 'experiment_id': experiment_id, 'modality': modality}
+    print(f'Processing: {params}')
+    os.makedirs(params['session_path'], exist_ok=True)
+    process_study(**params)
+    return experiment_id
+
+
+def init_worker(settings, id_df_, empty_dirs_, non_empty_dirs_):
+    ## Spawned worker: copy the parent's settings and lookups, then open this process's own error/manifest connections.
+    ## (Forked workers deadlock in polars if the parent has already used its thread pool.)
+    global id_df, empty_dirs, non_empty_dirs
+    globals().update(settings)
+    id_df, empty_dirs, non_empty_dirs = id_df_, empty_dirs_, non_empty_dirs_
+    init_outputs()
+
+def organise_subset(subset, row):
+    ## One study's rows from the audit DB -- id_df and the inbox directory sets are set by main() or init_worker()
+    with tracing.span('study', study_uid=row['study_uid']):
+        return organise_study(subset, row, id_df, empty_dirs, non_empty_dirs)
+
+def read_targets(conn):
+    """
+    dicomdb rows for target_patients and target_studies only.
+    Lookups by patient_id use dicomdb's unique index (patient_id is its first column); studies are mapped to
+    their patients through study_summary (see audit_summary.py) so they can use it as well.
+    """
+    patients, studies = set(target_patients or []), list(target_studies or [])
+    has_summary = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'study_summary'").fetchone() is not None
+    lookups = [('patient_id', list(patients))]
+    if studies and has_summary:
+        placeholders = ', '.join('?' * len(studies))
+        lookups[0][1].extend(x for (x,) in conn.execute(f"SELECT DISTINCT patient_id FROM study_summary WHERE study_uid IN ({placeholders})", studies))
+    elif studies:
+        lookups.append(('study_uid', studies)) # Older audit DB -- full table scan
+
+    rows, columns = [], None
+    for column, values in lookups:
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            cursor = conn.execute(f"SELECT * FROM dicomdb WHERE {column} IN ({', '.join('?' * len(chunk))})", chunk)
+            columns = [x[0] for x in cursor.description]
+            rows.extend(cursor.fetchall())
+    if columns is None:
+        columns = [x[0] for x in conn.execute("SELECT * FROM dicomdb LIMIT 0").description]
+    df = pl.DataFrame(rows, schema=columns, orient='row').unique('id', maintain_order=True)
+    ## Rows fetched for a study's patient include the patient's other studies -- keep only what was asked for
+    return df.filter(pl.col("patient_id").is_in(list(patients)) | pl.col("study_uid").is_in(studies))
+
+def report_compression():
+    for (modality, transfer_syntax), x in sorted(inbox_manifest.get_compression_report(manifest, PROJECT).items(), key=str):
+        ratio = 'n/a' if x['ratio'] is None else f"{x['ratio']:.2f}x"
+        cpu = 'n/a' if x['cpu_ms_per_file'] is None else f"{x['cpu_ms_per_file']:.1f} ms/file"
+        print(f"{modality} ({transfer_syntax_name(transfer_syntax)}): {x['files']} files in {x['experiments']} experiments, "
+              f"ratio {ratio} vs source, write CPU {cpu}, {x['saved_gb']:.1f} GB saved")
 
-        #break
+def main():
+    global id_df, empty_dirs, non_empty_dirs
+    tracing.start_profiler()
+    check_compressors()
+    init_outputs()
+    id_df = load_id_mapping()
+
+    os.makedirs(os.path.join(target_dir, PROJECT), exist_ok=True)    
+    targeted = bool(target_patients or target_studies)
+
+    if targeted:
+        ## organise_study checks each session directory itself, so there's no need to list the whole inbox
+        empty_dirs, non_empty_dirs = set(), set()
+    else:
+        with tracing.span('scan_for_empty_directories'):
+            empty_dirs, non_empty_dirs = scan_for_empty_directories(os.path.join(target_dir, PROJECT))
+        print(f'Found {len(empty_dirs)} empty directories and {len(non_empty_dirs)} non-empty directories.')
+        print(empty_dirs)
+        empty_dirs, non_empty_dirs = set(empty_dirs), set(non_empty_dirs)
+    #exit()
+    # Connect to imaging database
+    conn = create_connection(db_filename)
+    with tracing.span('read_database'):
+        df = read_targets(conn) if targeted else pl.read_database("SELECT * from dicomdb", conn)
+    #df = pl.read_csv('./outputs/audit/debugging_AltID892.csv')#csv_filename)
+
+    num_patients = df.select("patient_id").n_unique()
+    # Group by study UID
+    # Don't do by series UID otherwise XNAT groups everything by series.
+    groups = df.unique("study_uid", maintain_order=True)
+    print(f"{num_patients} patient(s) with {len(groups)} studies to process")
+
+    rows = groups.rows(named=True)
+    subsets = {x['study_uid'][0]: x for x in df.partition_by('study_uid', maintain_order=True)}
+    if organise_workers > 1:
+        ## Each worker is sent one study's rows at a time
+        settings = {name: globals()[name] for name in worker_settings}
+        with ProcessPoolExecutor(organise_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker,
+                                 initargs=(settings, id_df, empty_dirs, non_empty_dirs)) as executor:
+            futures = [executor.submit(organise_subset, subsets[row['study_uid']], row) for row in rows]
+            for future in tqdm(as_completed(futures), total=len(futures), position=0):
+                future.result()
+    else:
+        for row in tqdm(rows, position=0):
+            organise_subset(subsets[row['study_uid']], row)
+    report_compression()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,372 @@
+"""
+Streaming pipeline: scan -> organise -> upload in one run.
+
+Each top-level (patient) directory is organised as soon as it has been scanned,
+and each experiment is uploaded as soon as it has been written to the inbox.
+Every stage has its own worker pool; stages are connected by bounded queues so a fast stage
+can't run far ahead of a slow one. Progress is checkpointed in a SQLite table so a restarted run
+picks up where it stopped.
+If a stage fails, the other stages stop at their next queue get/put (work already handed to a pool
+finishes first) and the first error is raised from main(). A restart resumes from the checkpoint.
+
+Assumes one patient per top-level directory (PatientID/Study Description/Series Description),
+the same assumption scrape_dicom_directory_v3.py makes.
+"""
+import os
+import glob
+import queue
+import sqlite3
+import threading
+import time
+import importlib.util
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import polars as pl
+import scrape_dicom_directory_v3 as scanner
+import organise_for_inbox as organiser
+import inbox_manifest
+import xnat_cache
+import xnat_session
+import tracing
+
+trial_arm = 'AG'
+PROJECT = 'STAMPEDE-AG'
+## Path to raw data
+root_dir = '/mnt/j/All Scans/AG'
+## Audit database written by the scanner and read by organise
+db_filename = f'./outputs/audit/allScansData_{trial_arm}.db'
+## Inbox (mounted at /data/xnat/inbox on the XNAT container)
+target_dir = '/mnt/d/xnat/1.8/inbox/'
+checkpoint_filename = f'./outputs/audit/pipeline_{trial_arm}.db'
+
+## Workers per stage
+scan_workers = 8
+organise_workers = 4
+upload_workers = 2
+## Max items waiting between stages before the upstream stage pauses
+queue_size = 16
+## Seconds between checks for a failed stage while waiting on a queue
+queue_timeout = 1
+
+uploader_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload-from-inbox.py')
+
+checkpoint_schema = """CREATE TABLE IF NOT EXISTS pipeline_state (
+    item text NOT NULL,
+    stage text NOT NULL,
+    status text NOT NULL,
+    updated_at text,
+    PRIMARY KEY (item, stage)
+    );"""
+## Experiments written for each organised top-level directory, re-queued for upload on restart
+organised_schema = """CREATE TABLE IF NOT EXISTS organised_experiments (
+    top_dir text NOT NULL,
+    experiment_id text NOT NULL,
+    PRIMARY KEY (top_dir, experiment_id)
+    );"""
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def load_uploader():
+    ## upload-from-inbox.py can't be imported by name because of the hyphens
+    spec = importlib.util.spec_from_file_location('upload_from_inbox', uploader_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def configure(uploader):
+    ## Point every stage at the same arm/project/databases
+    scanner.trial_arm = trial_arm
+    scanner.root_dir = root_dir
+    scanner.db_filename = db_filename
+    organiser.trial_arm = trial_arm
+    organiser.PROJECT = PROJECT
+    organiser.db_filename = db_filename
+    organiser.target_dir = target_dir
+    organiser.manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
+    organiser.error_filename = f'./logs/ERRORS-{trial_arm}-pipeline-{datetime.now().strftime("%Y-%m-%d--%H:%M")}.db'
+    uploader.PROJECT = PROJECT
+    uploader.manifest_filename = organiser.manifest_filename
+
+def init_checkpoint():
+    conn = sqlite3.connect(checkpoint_filename, timeout=60)
+    conn.execute(checkpoint_schema)
+    conn.execute(organised_schema)
+    conn.commit()
+    return conn
+
+def get_done(conn, stage):
+    rows = conn.execute("SELECT item FROM pipeline_state WHERE stage = ? AND status = 'done'", (stage,)).fetchall()
+    return {x for (x,) in rows}
+
+def set_status(conn, item, stage, status):
+    conn.execute("INSERT OR REPLACE INTO pipeline_state (item, stage, status, updated_at) VALUES (?, ?, ?, ?)",
+                 (item, stage, status, datetime.now().isoformat()))
+    conn.commit()
+
+def set_organised(conn, top_dir, experiment_ids):
+    conn.executemany("INSERT OR IGNORE INTO organised_experiments (top_dir, experiment_id) VALUES (?, ?)",
+                     [(top_dir, x) for x in experiment_ids])
+    set_status(conn, top_dir, 'organise', 'done')
+
+def get_organised(conn, top_dir):
+    return [x for (x,) in conn.execute("SELECT experiment_id FROM organised_experiments WHERE top_dir = ?", (top_dir,))]
+
+class StageError(Exception):
+    ## Raised in a stage that has to stop because another stage failed
+    pass
+
+class Failure:
+    ## First exception raised by any stage
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.stage = None
+        self.error = None
+
+    def set(self, stage, error):
+        with self.lock:
+            if self.error is None:
+                self.stage, self.error = stage, error
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set()
+
+def put(q, item, failure):
+    ## queue.put that gives up once any stage has failed, instead of blocking forever on a queue nobody reads
+    while True:
+        if failure.is_set():
+            raise StageError(f'{failure.stage} stage failed')
+        try:
+            q.put(item, timeout=queue_timeout)
+            return
+        except queue.Full:
+            pass
+
+def get(q, failure):
+    ## queue.get that gives up once any stage has failed
+    while True:
+        if failure.is_set():
+            raise StageError(f'{failure.stage} stage failed')
+        try:
+            return q.get(timeout=queue_timeout)
+        except queue.Empty:
+            pass
+
+def run_stage(name, fn, downstream, failure, *args):
+    ## Thread target: record the first error and always tell the next stage there's nothing more coming
+    try:
+        fn(*args, failure)
+    except StageError as e:
+        print(f'{name} stage stopped: {e}')
+    except Exception as e:
+        print(f'{name} stage failed: {e!r}')
+        failure.set(name, e)
+    finally:
+        if downstream is not None:
+            try:
+                put(downstream, None, failure)
+            except StageError:
+                pass
+
+def start_pool(executor):
+    ## Fork every worker now, from the main thread, before the stage threads (and their locks) exist.
+    ## With the fork context all workers are started on the first submit and never replaced.
+    executor.submit(int).result()
+    return executor
+
+def bounded_submit(executor, in_flight, limit, handle, item, fn, *args):
+    ## Submit fn(*args) for `item`, first handling finished tasks while `limit` tasks are already running
+    while len(in_flight) >= limit:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            handle(future, in_flight.pop(future))
+    in_flight[executor.submit(fn, *args)] = item
+
+def drain(in_flight, handle):
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            handle(future, in_flight.pop(future))
+
+#### ++++++++++++++++++ STAGE 1: SCAN +++++++++++++++++
+def scan_stage(paths, organise_queue, executor, failure):
+    checkpoint = init_checkpoint()
+    done = get_done(checkpoint, 'scan')
+    print(f'Scan: {len(done)} of {len(paths)} directories already scanned')
+    for path in paths:
+        if path in done:
+            put(organise_queue, path, failure)
+
+    def handle(future, path):
+        try:
+            future.result()
+        except Exception as e:
+            print(f'Scan failed for {path}: {e}')
+            set_status(checkpoint, path, 'scan', 'failed')
+            return
+        set_status(checkpoint, path, 'scan', 'done')
+        put(organise_queue, path, failure) # Blocks while organise is behind
+
+    in_flight = {}
+    for path in paths:
+        if path not in done:
+            bounded_submit(executor, in_flight, scan_workers, handle, path, scanner.scan_top_level, path)
+    drain(in_flight, handle)
+    print('Scan stage finished')
+
+#### ++++++++++++++++++ STAGE 2: ORGANISE +++++++++++++
+def init_organise_worker():
+    global id_df
+    organiser.init_outputs()
+    id_df = organiser.load_id_mapping()
+
+def organise_directory(top_dir):
+    ## Organise every study found under one scanned top-level directory. Returns the experiment IDs in the inbox.
+    with sqlite3.connect(db_filename, timeout=60) as conn:
+        ## Range on dirname so the dirname index is used
+        cursor = conn.execute("SELECT * FROM dicomdb WHERE dirname = ? OR (dirname >= ? AND dirname < ?)",
+                              (top_dir, top_dir + os.sep, top_dir + chr(ord(os.sep) + 1)))
+        columns = [x[0] for x in cursor.description]
+        rows = cursor.fetchall()
+    if not rows:
+        return []
+    df = pl.DataFrame(rows, schema=columns, orient='row')
+
+    experiment_ids = []
+    for study in df.partition_by('study_uid', maintain_order=True):
+        row = study.row(0, named=True)
+        with tracing.span('study', category='organise', study_uid=row['study_uid']):
+            experiment_id = organiser.organise_study(study, row, id_df)
+        if experiment_id is not None:
+            experiment_ids.append(experiment_id)
+    return experiment_ids
+
+def organise_stage(organise_queue, upload_queue, executor, failure):
+    checkpoint = init_checkpoint()
+    done = get_done(checkpoint, 'organise')
+    num_experiments = 0
+
+    def handle(future, top_dir):
+        nonlocal num_experiments
+        try:
+            experiment_ids = future.result()
+        except Exception as e:
+            print(f'Organise failed for {top_dir}: {e}')
+            set_status(checkpoint, top_dir, 'organise', 'failed')
+            return
+        set_organised(checkpoint, top_dir, experiment_ids)
+        for experiment_id in experiment_ids:
+            num_experiments += 1
+            put(upload_queue, experiment_id, failure) # Blocks while upload is behind
+
+    in_flight = {}
+    while True:
+        top_dir = get(organise_queue, failure)
+        if top_dir is None:
+            break
+        if top_dir in done:
+            ## Organised in an earlier run -- queue its experiments again (upload skips those already done)
+            for experiment_id in get_organised(checkpoint, top_dir):
+                num_experiments += 1
+                put(upload_queue, experiment_id, failure)
+            continue
+        bounded_submit(executor, in_flight, organise_workers, handle, top_dir, organise_directory, top_dir)
+    drain(in_flight, handle)
+    print(f'Organise stage finished: {num_experiments} experiments in the inbox')
+
+#### ++++++++++++++++++ STAGE 3: UPLOAD +++++++++++++++
+def upload_stage(upload_queue, uploader, start, failure):
+    checkpoint = init_checkpoint()
+    done = get_done(checkpoint, 'upload')
+    manifest = inbox_manifest.init_manifest(uploader.manifest_filename)
+    cache_conn = xnat_cache.init_cache(uploader.cache_filename)
+    source_dir = os.path.join(target_dir, PROJECT, '')
+    first_upload = None
+    counts = {'uploaded': 0, 'failed': 0, 'skipped': 0}
+
+    with xnat_session.create_session(pool_size=upload_workers) as sess:
+        xnat_cache.refresh_cache(cache_conn, sess, uploader.url, PROJECT)
+        in_xnat = xnat_cache.get_experiment_labels(cache_conn, PROJECT)
+
+        def handle(future, experiment_id):
+            nonlocal first_upload
+            try:
+                result = future.result()
+            except Exception as e:
+                counts['failed'] += 1
+                print(f'Upload failed for {experiment_id}: {e!r}')
+                set_status(checkpoint, experiment_id, 'upload', 'failed')
+                return
+            if result['status'] == 200:
+                counts['uploaded'] += 1
+                set_status(checkpoint, result['expt_id'], 'upload', 'done')
+                if first_upload is None:
+                    first_upload = time.time() - start
+                    print(f'First upload finished {first_upload:.0f}s after starting')
+            else:
+                counts['failed'] += 1
+                print(f"Upload failed with status code: {result['status']} -- {result['expt_id']}")
+                set_status(checkpoint, result['expt_id'], 'upload', 'failed')
+            inbox_manifest.record_upload(manifest, PROJECT, result['expt_id'], result['status'],
+                                         result['attempts'], result['elapsed'])
+
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            while True:
+                experiment_id = get(upload_queue, failure)
+                if experiment_id is None:
+                    break
+                if experiment_id in done or experiment_id in in_xnat:
+                    counts['skipped'] += 1
+                    continue
+                upload = os.path.join(source_dir, experiment_id)
+                bounded_submit(executor, in_flight, upload_workers, handle, experiment_id,
+                               uploader.upload_experiment, sess, upload, source_dir, None)
+            drain(in_flight, handle)
+    print(f'Upload stage finished: {counts}')
+
+def main():
+    start = time.time()
+    uploader = load_uploader()
+    configure(uploader)
+    organiser.check_compressors()
+    init_checkpoint().close()
+    tracing.start_profiler()
+
+    ## Scanner state (directories already in the audit DB) -- inherited by the forked scan workers
+    scanner.paths_to_skip = scanner.init_db(db_filename)
+    with sqlite3.connect(db_filename) as conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS dicomdb_dirname ON dicomdb(dirname)")
+    os.makedirs(os.path.join(target_dir, PROJECT), exist_ok=True)
+
+    paths = glob.glob(os.path.join(root_dir, '*'))
+    print(f"------ Pipeline for {len(paths)} paths in {root_dir} -> {PROJECT} -------")
+    organise_queue = queue.Queue(maxsize=queue_size)
+    upload_queue = queue.Queue(maxsize=queue_size)
+    mp_context = multiprocessing.get_context('fork')
+    failure = Failure()
+
+    with start_pool(ProcessPoolExecutor(scan_workers, mp_context=mp_context)) as scan_executor, \
+            start_pool(ProcessPoolExecutor(organise_workers, mp_context=mp_context, initializer=init_organise_worker)) as organise_executor:
+        stages = [
+            threading.Thread(target=run_stage, args=('scan', scan_stage, organise_queue, failure,
+                                                     paths, organise_queue, scan_executor), name='scan'),
+            threading.Thread(target=run_stage, args=('organise', organise_stage, upload_queue, failure,
+                                                     organise_queue, upload_queue, organise_executor), name='organise'),
+            threading.Thread(target=run_stage, args=('upload', upload_stage, None, failure,
+                                                     upload_queue, uploader, start), name='upload'),
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+    if failure.error is not None:
+        raise failure.error
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
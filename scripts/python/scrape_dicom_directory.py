@@ -9,6 +9,7 @@ import sqlite3
 from tqdm import tqdm
 import SimpleITK as sitk
 import traceback
+import tracing
 
 ## PATHS
 OS = 'UNIX' # or UNIX --- this is just to handle different paths
@@ -199,8 +200,10 @@ def main():
     skip = False # Use this as a flag to quickly skip all directories up to end_skip 
     end_skip = '/mnt/j/All\\ Scans/' #! THIS NEEDS TO BE UPDATED
 
+    tracing.start_profiler()
     for arm in arms_to_check:
-        init_db(f'./outputs/audit/allScansData_{arm}.db')
+        with tracing.span('init_db', arm=arm):
+            init_db(f'./outputs/audit/allScansData_{arm}.db')
         #TODO replace with commented out line if not scanning AK.
         #source_dir = root_dir
         source_dir = os.path.join(root_dir, arm)
@@ -218,8 +221,11 @@ def main():
                 continue
 
             print(f'Scanning {path}')
-            filepaths = filter_filepaths(path)
-            collect_subject_info(filepaths, arm)
+            with tracing.span('scan_top_level', path=path):
+                with tracing.span('filter_filepaths'):
+                    filepaths = filter_filepaths(path)
+                with tracing.span('collect_subject_info', paths=len(filepaths)):
+                    collect_subject_info(filepaths, arm)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -11,6 +11,7 @@ from tqdm import tqdm
 import time
 from multiprocessing import Process, Queue, Pool, Manager, cpu_count
 from queue import Empty
+import tracing
 
 
 
@@ -65,8 +66,10 @@ error_schema = """CREATE TABLE IF NOT EXISTS errors (
 #### +++++++++++++++++++++++++++++++++++++++++++++++++
 def main():
     global paths_to_skip
+    tracing.start_profiler()
     ## Initialise the database and figure out what paths have been analysed
-    paths_to_skip = init_db(db_filename)
+    with tracing.span('init_db'):
+        paths_to_skip = init_db(db_filename)
 
     ## Go through source dir and get top-level directories to process (usually by patientID)
     paths_to_scan = glob.glob(os.path.join(root_dir, '*'))
@@ -75,7 +78,7 @@ def main():
     ## Add tasks to queue and allocate to separate workers
     task_queue = Queue()
     print('Finding directories to scan...')
-    with Pool(cpus_to_use) as pool:
+    with tracing.span('filter_directories', paths=len(paths_to_scan)), Pool(cpus_to_use) as pool:
         res = pool.map(filter_directories, [path for path in paths_to_scan])
     
     ## Flatten results from all workers
@@ -91,11 +94,13 @@ def main():
         workers.append(p)
 
     # Wait for workers to finish
-    for p in workers:
-        p.join()
+    with tracing.span('scan'):
+        for p in workers:
+            p.join()
 
 
 def process_directory(task_queue):
+    profiler = tracing.start_profiler()
     while True:
         try:
             job = task_queue.get(timeout=0.001)
@@ -105,7 +110,9 @@ def process_directory(task_queue):
         if job['path'] is None:
             print('No path')
             break
-        scan_directory(job)
+        with tracing.span('directory', path=job['path'] if job['type'] != 'file' else os.path.dirname(job['path'][0])):
+            scan_directory(job)
+    tracing.stop_profiler(profiler)
 
 ### HELPERS ###
 def create_connection(db_file):
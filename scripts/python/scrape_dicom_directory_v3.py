@@ -1,27 +1,69 @@
 """
 Script for scraping a directory of DICOM files
 And generating a database with information from headers
+
+Zip/tar archives are scanned in place (see archive_io.py): each archive is one task, its members are stored
+as '{archive}!/{member}' with the archive as their dirname.
 """
 
+import io
 import os
 import sqlite3
 import glob
 from tqdm import tqdm
 import time
-from multiprocessing import Process, Queue, Pool, Manager, cpu_count
+from multiprocessing import Process, Queue, Pool, Manager, Array, Value, cpu_count
 from queue import Empty
 import pydicom
+from pydicom.multival import MultiValue
+import archive_io
+import audit_summary
+import series_stats
+import tracing
 
 # What trial arm does the data belong to?
 trial_arm = 'AJ'
 # Path to raw data
 root_dir = '/mnt/md0/stampede/AJ-test' 
+## Every root to scan in this run (can be on different disks)
+root_dirs = [root_dir]
+## Targeted scan: only the top-level directories holding these patient IDs / study UIDs (None = everything).
+## Resolved through the dir_index table (directory -> patient/study, updated after every scan).
+## Patients not in the index yet are looked for as top-level directories named after the patient ID.
+target_patients = None
+target_studies = None
 ## Database name 
 db_filename = f'./outputs/audit/allScansData_{trial_arm}_TEST_v3.db'
 
 ## CPU cores to use when multiprocessing
 cpus_to_use=cpu_count()//2
 
+## Roots are grouped by the device they're on and each device gets its own pool of readers.
+## Fixed reader counts per device, keyed by any path on it, e.g. {'/mnt/md0': 16, '/mnt/j': 2}.
+## Devices not listed are auto-tuned: readers are added one at a time while files/sec keeps improving.
+device_workers = {}
+auto_tune = True # False: devices not in device_workers use cpus_to_use readers
+min_device_workers = 1
+max_device_workers = cpus_to_use
+tune_interval = 30 # seconds between tuning steps
+tune_threshold = 0.1 # minimum relative gain in files/sec to keep an extra reader
+
+## Bulk-load mode for first scans: dicomdb is created without its UNIQUE index and loaded with relaxed pragmas,
+## then de-duplicated and indexed in one pass at the end. Re-running after a crash resumes the load.
+bulk_load = False
+bulk_pragmas = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL', # Safe with WAL -- a crash can only lose the last commits, which get rescanned
+    'PRAGMA cache_size=-1048576', # 1GB
+    'PRAGMA mmap_size=4294967296',
+    'PRAGMA temp_store=MEMORY',
+]
+
+## Bytes read from the start of each archive member -- enough for the header of most files.
+## Members whose pixel data doesn't start within this prefix are read in full.
+header_prefix_bytes = 64 * 1024
+pixel_data_tag = b'\xe0\x7f\x10\x00' # (7FE0,0010) little endian
+
 ## If any of these appear in the directory structure -- skip them 
 SKIP_DIR_PATTERN = ['[CT - KEY IMAGES]', '[PT - KEY IMAGES]', '[NM - SAVE SCREENS]']
 
@@ -33,9 +75,20 @@ header_keys = {
     'series_uid': (0x0020, 0x000e),
     'study_uid': (0x0020,0x000d),
     'modality': (0x0008,0x0060),
-    'acquisition_date': (0x0008, 0x0022)
+    'acquisition_date': (0x0008, 0x0022),
+    ## Used for per-series completeness stats (see series_stats.py)
+    'instance_number': (0x0020, 0x0013),
+    'image_position': (0x0020, 0x0032),
+    'number_of_frames': (0x0028, 0x0008),
 }
 
+## Workers build plain tuples in this column order; the INSERTs are prepared once and run with executemany
+header_tags = list(header_keys.values())
+row_columns = list(header_keys) + ['filepath', 'dirname', 'trial_arm']
+not_null_columns = [row_columns.index(x) for x in ('patient_id', 'series_uid', 'study_uid')]
+insert_row_sql = f"INSERT OR IGNORE INTO dicomdb ({', '.join(row_columns)}) VALUES ({', '.join('?' * len(row_columns))})"
+insert_error_sql = "INSERT OR IGNORE INTO errors (filepath, dirname, error) VALUES (?, ?, ?)"
+
 #++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
 schema = """CREATE TABLE IF NOT EXISTS dicomdb (
     id integer PRIMARY KEY,
@@ -49,9 +102,42 @@ schema = """CREATE TABLE IF NOT EXISTS dicomdb (
     series_date text,
     study_date text,
     acquisition_date text,
+    instance_number integer,
+    image_position text,
+    number_of_frames integer,
     UNIQUE(patient_id, series_uid, study_uid, filepath, dirname, modality, series_date, study_date, acquisition_date)
     );"""
 
+## Bulk-load version: same table, uniqueness enforced by an index built after loading
+unique_columns = 'patient_id, series_uid, study_uid, filepath, dirname, modality, series_date, study_date, acquisition_date'
+bulk_schema = schema.replace(f""",
+    UNIQUE({unique_columns})""", '')
+## Columns added after the first databases were made -- added to older DBs by init_db.
+## Rows already in those DBs keep NULLs here (their series show as 'unknown' in series_stats).
+added_columns = {'instance_number': 'integer', 'image_position': 'text', 'number_of_frames': 'integer'}
+unique_index = f"CREATE UNIQUE INDEX IF NOT EXISTS dicomdb_unique ON dicomdb({unique_columns})"
+bulk_state_schema = """CREATE TABLE IF NOT EXISTS bulk_load_state (
+    id integer PRIMARY KEY,
+    started_at real,
+    finished integer NOT NULL DEFAULT 0
+    );"""
+
+dir_index_schemas = [
+    """CREATE TABLE IF NOT EXISTS dir_index (
+    dirname text NOT NULL,
+    patient_id text NOT NULL,
+    study_uid text NOT NULL,
+    PRIMARY KEY (dirname, study_uid)
+    );""",
+    "CREATE INDEX IF NOT EXISTS dir_index_patient ON dir_index(patient_id);",
+    "CREATE INDEX IF NOT EXISTS dir_index_study ON dir_index(study_uid);",
+    ## Last dicomdb id added to the index
+    """CREATE TABLE IF NOT EXISTS dir_index_state (
+    id integer PRIMARY KEY CHECK (id = 1),
+    last_id integer NOT NULL
+    );""",
+]
+
 error_schema = """CREATE TABLE IF NOT EXISTS errors (
     id integer PRIMARY KEY,
     filepath text NOT NULL,
@@ -63,38 +149,145 @@ error_schema = """CREATE TABLE IF NOT EXISTS errors (
 #### +++++++++++++++++++++++++++++++++++++++++++++++++
 def main():
     global paths_to_skip
+    tracing.start_profiler()
     ## Initialise the database and figure out what paths have been analysed
-    paths_to_skip = init_db(db_filename)
+    with tracing.span('init_db'):
+        paths_to_skip = init_db(db_filename)
 
-    ## Go through source dir and get top-level directories to process (usually by patientID)
-    paths_to_scan = glob.glob(os.path.join(root_dir, '*'))
-    print(f"------ Processing {len(paths_to_scan)} paths in {root_dir} -------")
-    
-    ## Add tasks to queue and allocate to separate workers
-    task_queue = Queue()
+    ## Go through source dirs and get top-level directories to process (usually by patientID), grouped by device
+    if target_patients or target_studies:
+        with create_connection(db_filename) as conn:
+            paths_to_scan = resolve_targets(conn)
+    else:
+        paths_to_scan = [path for root in root_dirs for path in glob.glob(os.path.join(root, '*'))]
+    print(f"------ Processing {len(paths_to_scan)} paths in {root_dirs} -------")
+    paths_by_device = group_by_device(paths_to_scan)
+    fixed_workers = {os.stat(path).st_dev: n for path, n in device_workers.items()}
+
+    ## Walk every device at once, each with its own number of processes
     print('Finding directories to scan...')
-    with Pool(cpus_to_use) as pool:
-        res = pool.map(filter_directories, [path for path in paths_to_scan])
-    
+    pools, results = [], {}
+    for device, paths in paths_by_device.items():
+        pool = Pool(fixed_workers.get(device, cpus_to_use))
+        pools.append(pool)
+        results[device] = pool.map_async(filter_directories, paths)
     ## Flatten results from all workers
-    tasks = [x for r in res for x in r]
-    for t in tasks:
-        task_queue.put(t)
-
-    print(f'Using {cpus_to_use} CPUs to process approx. {task_queue.qsize()} directories')
-    workers=[]
-    for _ in range(cpus_to_use):
-        p = Process(target=process_directory, args=(task_queue,))
-        p.start()
-        workers.append(p)
-
-    # Wait for workers to finish
-    for p in workers:
-        p.join()
-
-
-def process_directory(task_queue):
+    tasks = {device: [x for r in res.get() for x in r] for device, res in results.items()}
+    for pool in pools:
+        pool.close()
+
+    schedulers = []
+    for device, device_tasks in tasks.items():
+        tuned = auto_tune and device not in fixed_workers
+        workers = min_device_workers if tuned else fixed_workers.get(device, cpus_to_use)
+        scheduler = DeviceScheduler(device, mount_point(paths_by_device[device][0]), device_tasks, workers, tuned)
+        print(f"Device {device} ({scheduler.name}): {len(device_tasks)} directories, "
+              f"{'auto-tuned from ' if tuned else ''}{workers} readers")
+        scheduler.start()
+        schedulers.append(scheduler)
+
+    # Wait for workers to finish, adjusting readers on auto-tuned devices every tune_interval
+    ## (checked every second so small scans don't wait a whole interval)
+    next_tune = time.time() + tune_interval
+    while any(x.alive() for x in schedulers):
+        time.sleep(min(1, tune_interval))
+        if time.time() >= next_tune:
+            for scheduler in schedulers:
+                scheduler.tune()
+            next_tune = time.time() + tune_interval
+    for scheduler in schedulers:
+        scheduler.join()
+        print(scheduler.summary())
+
+    if bulk_load:
+        with tracing.span('finish_bulk_load'):
+            finish_bulk_load(db_filename)
+
+    ## Completeness stats for series that are new or changed in this run
+    with tracing.span('series_stats'), create_connection(db_filename) as conn:
+        print(f'Updated completeness stats for {series_stats.update_series_stats(conn)} series')
+    with tracing.span('dir_index'), create_connection(db_filename) as conn:
+        update_dir_index(conn)
+
+
+class DeviceScheduler:
+    """
+    Reader processes for the directories on one device.
+    Readers with index >= limit exit after their current directory, so the reader count can go up or down
+    while the scan runs. With tuning on, tune() hill-climbs: add a reader while files/sec improves by more
+    than tune_threshold, otherwise drop the last one added and keep that setting.
+    """
+    def __init__(self, device, name, tasks, workers, tuning):
+        self.device = device
+        self.name = name
+        self.task_queue = Queue()
+        for t in tasks:
+            self.task_queue.put(t)
+        self.stats = Array('d', 2) # files read, seconds spent reading
+        self.limit = Value('i', workers)
+        self.processes = {}
+        self.tuning = tuning
+        self.best_rate = 0.0
+        self.history = []
+        self.last_time, self.last_files = time.time(), 0.0
+
+    def start(self):
+        for index in range(self.limit.value):
+            if index not in self.processes or not self.processes[index].is_alive():
+                p = Process(target=process_directory, args=(self.task_queue, self.stats, index, self.limit))
+                p.start()
+                self.processes[index] = p
+
+    def alive(self):
+        return any(p.is_alive() for p in self.processes.values())
+
+    def join(self):
+        for p in self.processes.values():
+            p.join()
+
+    def tune(self):
+        now, files = time.time(), self.stats[0]
+        rate = (files - self.last_files) / (now - self.last_time)
+        self.last_time, self.last_files = now, files
+        self.history.append((self.limit.value, rate))
+        if not self.tuning or not self.alive() or rate == 0:
+            return
+        if rate > self.best_rate * (1 + tune_threshold) and self.limit.value < max_device_workers:
+            self.best_rate = rate
+            self.limit.value += 1
+            self.start()
+        else:
+            ## The last reader added didn't help (or we're at the max) -- keep the best setting found
+            if rate <= self.best_rate * (1 + tune_threshold) and self.limit.value > min_device_workers:
+                self.limit.value -= 1
+            self.tuning = False
+            print(f'Device {self.device} ({self.name}): settled on {self.limit.value} readers')
+
+    def summary(self):
+        files, seconds = self.stats[0], self.stats[1]
+        latency = f'{1000 * seconds / files:.1f} ms/file' if files else 'n/a'
+        return (f'Device {self.device} ({self.name}): {int(files)} files, {latency} per reader, '
+                f'{self.limit.value} readers, files/sec by readers: {[(n, round(r, 1)) for n, r in self.history]}')
+
+def group_by_device(paths):
+    ## {st_dev: [paths]} -- paths on the same disk/mount share a device number
+    devices = {}
+    for path in paths:
+        devices.setdefault(os.stat(path).st_dev, []).append(path)
+    return devices
+
+def mount_point(path):
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+def process_directory(task_queue, stats=None, index=0, limit=None):
+    profiler = tracing.start_profiler()
     while True:
+        ## Readers above the device's current limit stop (see DeviceScheduler)
+        if limit is not None and index >= limit.value:
+            break
         try:
             path = task_queue.get(timeout=0.001)
         except Empty:
@@ -103,20 +296,54 @@ def process_directory(task_queue):
         if path is None:
             print('No path')
             break
-        data = scan_directory(path)
-
-        with create_connection(db_filename) as conn:
-            cursor = conn.cursor()
-            for elem in data:
-                sql, item = elem['sql'], elem['header']
-                cursor.execute(sql, item)
-            conn.commit()
+        with tracing.span('directory', path=path):
+            start = time.perf_counter()
+            with tracing.span('scan_directory'):
+                data = scan_path(path)
+            if stats is not None:
+                with stats.get_lock():
+                    stats[0] += len(data)
+                    stats[1] += time.perf_counter() - start
+            with tracing.span('write_rows', rows=len(data)):
+                write_rows(data)
+    tracing.stop_profiler(profiler)
+
+class RowBatch:
+    ## Results of scanning one directory/archive: dicomdb rows (row_columns order) and errors (filepath, dirname, error)
+    __slots__ = ('rows', 'errors')
+
+    def __init__(self):
+        self.rows = []
+        self.errors = []
+
+    def __len__(self):
+        return len(self.rows) + len(self.errors)
+
+def write_rows(data):
+    with create_connection(db_filename) as conn:
+        cursor = conn.cursor()
+        cursor.executemany(insert_row_sql, data.rows)
+        cursor.executemany(insert_error_sql, data.errors)
+        conn.commit()
+
+def scan_top_level(source):
+    ## Scan every directory under one top-level (patient) directory -- used by pipeline.py
+    with tracing.span('scan_top_level', path=source):
+        for path in filter_directories(source):
+            with tracing.span('scan_directory', path=path):
+                data = scan_path(path)
+            with tracing.span('write_rows', rows=len(data)):
+                write_rows(data)
+    return source
 
 ### HELPERS ###
 def create_connection(db_file):
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, timeout=60)
+        if bulk_load:
+            for pragma in bulk_pragmas:
+                conn.execute(pragma)
         #print(f'SQLITE version:', sqlite3.version)
     except sqlite3.Error as e:
         print(e)
@@ -130,13 +357,20 @@ def create_table(conn, schema):
         print(e)
 
 def read_header(path):
+    ## Header values as a list in header_keys order (None if missing)
     ds = pydicom.dcmread(path, stop_before_pixels=True)
-    data = {}
-    for key, tag in header_keys.items():
-        group, element = tag
-        data[key] = str(ds[group, element].value) if [group, element] in ds else None
+    data = []
+    for tag in header_tags:
+        elem = ds.get(tag)
+        if elem is None:
+            data.append(None)
+            continue
+        value = elem.value
+        ## Multi-valued tags (ImagePositionPatient) are stored the way DICOM writes them: x\y\z
+        data.append('\\'.join(str(x) for x in value) if isinstance(value, MultiValue) else str(value))
     return data
 
+@tracing.traced('walk')
 def filter_directories(source):
     ## Creates list of directories to scan
     ## Drops directories that are already in the database
@@ -146,9 +380,16 @@ def filter_directories(source):
         if files:
             if any(pattern_to_skip in root for pattern_to_skip in SKIP_DIR_PATTERN):
                 continue
-            
+
+            ## Archives are scanned as their own tasks. Their rows are written in one go, so any rows mean it's done.
+            archives = [os.path.join(root, f) for f in files if archive_io.is_archive(f)]
+            paths.extend(x for x in archives if x not in paths_to_skip)
+            num_files = len(files) - len(archives)
+            if num_files == 0:
+                continue
+
             ## If this directory has been processed and all the files have been accounted for..
-            if root in paths_to_skip and len(files) == paths_to_skip[root]:
+            if root in paths_to_skip and num_files == paths_to_skip[root]:
                 #print('Skipping')
                 continue            
             paths.append(root)
@@ -156,70 +397,94 @@ def filter_directories(source):
     print(f"Found {len(paths)} paths to scan in {source}")
     return paths
 
-def record_error(path, e):
+def record_error(path, e, dirname=None):
     #print('ERROR:', e)
-    err = {'filepath': path, 'error': str(e), 'dirname': os.path.dirname(path)}
-    columns = ', '.join(err.keys())
-    placeholders = ':'+', :'.join(err.keys())
-    sql = """INSERT OR IGNORE INTO errors (%s) VALUES (%s)""" % (columns, placeholders)    
-    return {'sql': sql, 'header': err}
-    #queue.put((sql, err))
+    return (path, dirname or os.path.dirname(path), str(e))
+
+def scan_path(path):
+    if archive_io.is_archive(path):
+        return scan_archive(path)
+    return scan_directory(path)
+
+def make_row(header, filepath, dirname):
+    ## Tuple in row_columns order from read_header's values
+    ##  These entries can't be null in DB schema--if empty replace with filename
+    ## Should be very rare that these are empty but allows user to find the files and manually get info if needed.
+    for i in not_null_columns:
+        if header[i] is None:
+            header[i] = filepath
+    header.extend((filepath, dirname, trial_arm))
+    return tuple(header)
 
 def scan_directory(path):
 
-    data = []
+    data = RowBatch()
     with tqdm(os.scandir(path), position=1, leave=False) as p:
         for file in p:
-            filepath = os.path.join(path, file)
+            if archive_io.is_archive(file.name):
+                continue # Scanned separately by scan_archive
+            filepath = file.path
             try:
                 header = read_header(filepath)
             except Exception as e:
-                data.append(record_error(filepath, e))
+                data.errors.append(record_error(filepath, e))
                 continue
             if header is None:
-                data.append(record_error(filepath, "Can't open file!"))
+                data.errors.append(record_error(filepath, "Can't open file!"))
                 continue
 
-            header['filepath'] = filepath
-            header['trial_arm'] = trial_arm
-
-            ##  These entries can't be null in DB schema--if empty replace with filename
-            ## Should be very rare that these are empty but allows user to find the files and manually get info if needed.
-
-            if header['patient_id'] is None:
-                header['patient_id'] = filepath
-
-            if header['series_uid'] is None:
-                header['series_uid'] = filepath
-
-            if header['study_uid'] is None:
-                header['study_uid'] = filepath
-
             # Get dirname 
-            header['dirname'] = os.path.dirname(filepath)
+            data.rows.append(make_row(header, filepath, os.path.dirname(filepath)))
 
-            # Insert into db
-            columns = ', '.join(header.keys())
-            placeholders = ':'+', :'.join(header.keys())
-            sql = """INSERT OR IGNORE INTO dicomdb (%s) VALUES (%s)""" % (columns, placeholders)      
+    return data
 
-            data.append({'sql': sql, 'header': header})
+def read_member_header(f):
+    ## Parse the header from the first bytes of an archive member, reading the rest only if the header is longer
+    prefix = f.read(header_prefix_bytes)
+    if pixel_data_tag not in prefix:
+        prefix += f.read()
+    return read_header(io.BytesIO(prefix))
 
+def scan_archive(archive):
+    ## Members are read in archive order in a single pass. The archive is the dirname of every member.
+    data = RowBatch()
+    try:
+        for member, f in tqdm(archive_io.iter_members(archive), position=1, leave=False):
+            filepath = archive_io.member_path(archive, member)
+            try:
+                header = read_member_header(f)
+            except Exception as e:
+                data.errors.append(record_error(filepath, e, archive))
+                continue
+            data.rows.append(make_row(header, filepath, archive))
+    except Exception as e:
+        ## Corrupt/truncated archive -- keep what was read and record the error against the archive
+        data.errors.append(record_error(archive, e, archive))
     return data
 
 
 def init_db(db_filename):
     conn = create_connection(db_filename)
     cursor = conn.cursor()
+    bulk_active = bulk_load and start_bulk_load(conn)
     create_table(conn, schema)
     create_table(conn, error_schema)
+    add_missing_columns(conn)
+    ## Summary tables + triggers for fast progress reporting (see audit_summary.py)
+    ## In bulk-load mode the triggers are dropped and the summaries rebuilt at the end instead
+    if bulk_active:
+        audit_summary.drop_triggers(conn)
+    else:
+        audit_summary.init_summaries(conn)
     # Check the above worked
     res = cursor.execute("SELECT name from sqlite_master").fetchone()
     assert res is not None, "Database doesn't exist"
     
     ## Get filepaths already analysed
     ## Figure out directories to skip and number of files.
-    dicoms_to_skip = cursor.execute(f"SELECT dirname, COUNT(*) FROM dicomdb GROUP BY dirname").fetchall()
+    ## (Distinct files when bulk loading -- rows can be duplicated until finish_bulk_load runs)
+    count = 'COUNT(DISTINCT filepath)' if bulk_active else 'COUNT(*)'
+    dicoms_to_skip = cursor.execute(f"SELECT dirname, {count} FROM dicomdb GROUP BY dirname").fetchall()
     ## Convert to a dict
     paths_to_skip = {k: v for k, v in dicoms_to_skip}
 
@@ -237,6 +502,104 @@ def init_db(db_filename):
     conn.close()
     return paths_to_skip
 
+def update_dir_index(conn):
+    ## Add directory -> patient/study entries for rows inserted since the last update
+    for dir_index_schema in dir_index_schemas:
+        conn.execute(dir_index_schema)
+    res = conn.execute("SELECT last_id FROM dir_index_state WHERE id = 1").fetchone()
+    last_id = 0 if res is None else res[0]
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM dicomdb").fetchone()[0]
+    conn.execute("""INSERT OR IGNORE INTO dir_index (dirname, patient_id, study_uid)
+                    SELECT DISTINCT dirname, patient_id, study_uid FROM dicomdb WHERE id > ? AND id <= ?""",
+                 (last_id, max_id))
+    conn.execute("INSERT OR REPLACE INTO dir_index_state (id, last_id) VALUES (1, ?)", (max_id,))
+    conn.commit()
+
+def top_level_dir(dirname):
+    ## Top-level directory (under one of root_dirs) that contains dirname, or None
+    for root in root_dirs:
+        root = os.path.join(root, '')
+        if dirname.startswith(root):
+            return root + dirname[len(root):].split(os.sep)[0]
+    return None
+
+def resolve_targets(conn):
+    ## Top-level directories to scan for target_patients/target_studies
+    update_dir_index(conn)
+    patients, studies = list(target_patients or []), list(target_studies or [])
+    dirnames, found = set(), set()
+    for column, values in [('patient_id', patients), ('study_uid', studies)]:
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            rows = conn.execute(f"SELECT dirname, {column} FROM dir_index WHERE {column} IN ({', '.join('?' * len(chunk))})",
+                                chunk).fetchall()
+            dirnames.update(d for d, _ in rows)
+            found.update(x for _, x in rows)
+    paths = {top_level_dir(d) for d in dirnames} - {None}
+    ## Patients that haven't been scanned yet
+    for patient_id in set(patients) - found:
+        candidates = [os.path.join(root, patient_id) for root in root_dirs if os.path.isdir(os.path.join(root, patient_id))]
+        paths.update(candidates)
+        if candidates:
+            found.add(patient_id)
+    missing = (set(patients) | set(studies)) - found
+    if missing:
+        print(f"Couldn't find {len(missing)} requested patients/studies: {sorted(missing)[:20]}")
+    print(f"----- Targeted scan: {len(patients)} patients and {len(studies)} studies in {len(paths)} top-level directories -----")
+    return sorted(paths)
+
+def add_missing_columns(conn):
+    existing = {x[1] for x in conn.execute("PRAGMA table_info(dicomdb)")}
+    for column, column_type in added_columns.items():
+        if column not in existing:
+            print(f'Adding column {column} to dicomdb')
+            conn.execute(f"ALTER TABLE dicomdb ADD COLUMN {column} {column_type}")
+    conn.commit()
+
+def start_bulk_load(conn):
+    ## Create dicomdb without the unique index -- only possible for a new database (or one mid bulk-load)
+    ## Returns True if this run is bulk loading
+    cursor = conn.cursor()
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='dicomdb'").fetchone()
+    create_table(conn, bulk_state_schema)
+    state = cursor.execute("SELECT finished FROM bulk_load_state ORDER BY id DESC LIMIT 1").fetchone()
+    if exists and (state is None or state[0] == 1):
+        print('dicomdb already exists with its unique index: loading with bulk pragmas only')
+        return False
+    if state is None:
+        create_table(conn, bulk_schema)
+        cursor.execute("INSERT INTO bulk_load_state (started_at) VALUES (?)", (time.time(),))
+        print('----- Bulk-load mode: unique index will be built at the end -----')
+    else:
+        print('----- Resuming bulk load -----')
+    conn.commit()
+    return True
+
+def finish_bulk_load(db_filename):
+    ## De-duplicate and build the unique index in one pass, then rebuild summaries.
+    ## Safe to re-run if interrupted: each step is idempotent and the state row is only updated at the end.
+    conn = create_connection(db_filename)
+    cursor = conn.cursor()
+    state = cursor.execute("SELECT id FROM bulk_load_state WHERE finished = 0 ORDER BY id DESC LIMIT 1").fetchone()
+    if state is None:
+        conn.close()
+        return
+    print('Removing duplicate rows and building unique index...')
+    start = time.time()
+    cursor.execute(f"""DELETE FROM dicomdb WHERE id NOT IN
+                      (SELECT MIN(id) FROM dicomdb GROUP BY {unique_columns})""")
+    print(f'Removed {cursor.rowcount} duplicate rows')
+    cursor.execute(unique_index)
+    conn.commit()
+    for summary_schema in audit_summary.summary_schemas:
+        cursor.execute(summary_schema)
+    audit_summary.rebuild_summaries(conn)
+    audit_summary.init_summaries(conn)
+    cursor.execute("UPDATE bulk_load_state SET finished = 1 WHERE id = ?", (state[0],))
+    conn.commit()
+    cursor.execute("PRAGMA optimize")
+    conn.close()
+    print(f'Bulk load finished in {time.time() - start:.0f}s')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,167 @@
+"""
+Per-series completeness statistics from the header fields the v3 scanner records
+(InstanceNumber, ImagePositionPatient, NumberOfFrames).
+
+For every series: instance count, min/max instance number, missing instance numbers (gaps),
+duplicated instance numbers and whether the spacing between slice positions is consistent.
+Computed from the audit database only, so truncated series can be found without re-reading the source files.
+Used by the scanner (series_stats table in the audit DB), organise_for_inbox.py and verify_uploads.py.
+
+Run directly to update the table and list broken series.
+"""
+import math
+import sqlite3
+import time
+from datetime import datetime
+
+trial_arm = 'AG'
+db_filename = f'./outputs/audit/allScansData_{trial_arm}.db'
+
+## Relative difference between the smallest and largest slice spacing that still counts as consistent
+spacing_tolerance = 0.05
+
+#++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
+stats_schemas = [
+    """CREATE TABLE IF NOT EXISTS series_stats (
+    series_uid text PRIMARY KEY,
+    n_files integer NOT NULL,
+    n_instances integer,
+    n_frames integer,
+    min_instance integer,
+    max_instance integer,
+    n_missing integer,
+    n_duplicates integer,
+    min_spacing real,
+    max_spacing real,
+    status text NOT NULL,
+    updated_at text
+    );""",
+    "CREATE INDEX IF NOT EXISTS series_stats_status ON series_stats(status);",
+]
+## Needed to fetch the rows of one series without a full table scan
+series_index = "CREATE INDEX IF NOT EXISTS dicomdb_series_uid ON dicomdb(series_uid)"
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def parse_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def parse_position(value):
+    ## ImagePositionPatient is stored as 'x\y\z'
+    if value is None:
+        return None
+    try:
+        position = tuple(float(x) for x in str(value).strip('[]').replace(',', '\\').split('\\'))
+    except ValueError:
+        return None
+    return position if len(position) == 3 else None
+
+def spacing_range(positions):
+    ## (min, max) distance between neighbouring slice positions, or (None, None) if there are too few to tell
+    positions = sorted(set(positions))
+    if len(positions) < 3:
+        return None, None
+    ## Order slices along the axis they vary most in
+    axis = max(range(3), key=lambda i: max(p[i] for p in positions) - min(p[i] for p in positions))
+    positions.sort(key=lambda p: p[axis])
+    distances = [math.dist(a, b) for a, b in zip(positions, positions[1:])]
+    return min(distances), max(distances)
+
+def compute_stats(rows):
+    """
+    rows: [(instance_number, image_position, number_of_frames)] for every file in one series (values as stored in dicomdb)
+    Returns a dict of the series_stats columns (except series_uid/n_files).
+    status is 'ok', 'unknown' (no instance numbers recorded) or a comma-separated list of
+    'gaps', 'duplicates', 'irregular_spacing'.
+    """
+    instances = [x for x in (parse_int(r[0]) for r in rows) if x is not None]
+    frames = [parse_int(r[2]) or 1 for r in rows]
+    positions = [x for x in (parse_position(r[1]) for r in rows) if x is not None]
+    stats = {'n_instances': len(set(instances)), 'n_frames': sum(frames), 'min_instance': None, 'max_instance': None,
+             'n_missing': None, 'n_duplicates': None, 'min_spacing': None, 'max_spacing': None}
+    if not instances:
+        stats['status'] = 'unknown'
+        return stats
+
+    stats['min_instance'], stats['max_instance'] = min(instances), max(instances)
+    stats['n_missing'] = stats['max_instance'] - stats['min_instance'] + 1 - stats['n_instances']
+    stats['n_duplicates'] = len(instances) - stats['n_instances']
+    problems = []
+    if stats['n_missing']:
+        problems.append('gaps')
+    if stats['n_duplicates']:
+        problems.append('duplicates')
+    ## Spacing only means something for single-frame slices with one position each
+    if len(positions) == len(rows) and max(frames) == 1:
+        stats['min_spacing'], stats['max_spacing'] = spacing_range(positions)
+        if stats['min_spacing'] is not None and \
+                stats['max_spacing'] - stats['min_spacing'] > spacing_tolerance * max(stats['min_spacing'], 1e-3):
+            problems.append('irregular_spacing')
+    stats['status'] = ','.join(problems) or 'ok'
+    return stats
+
+def stats_by_series(rows):
+    ## rows: [(series_uid, instance_number, image_position, number_of_frames)] -> {series_uid: stats}
+    grouped = {}
+    for series_uid, *values in rows:
+        grouped.setdefault(series_uid, []).append(values)
+    return {series_uid: dict(compute_stats(values), n_files=len(values)) for series_uid, values in grouped.items()}
+
+def is_broken(stats):
+    return stats['status'] not in ('ok', 'unknown')
+
+def init_series_stats(conn):
+    for schema in stats_schemas:
+        conn.execute(schema)
+    conn.commit()
+
+def update_series_stats(conn):
+    """
+    Recompute stats for series that are new or have gained files since they were last computed.
+    File counts come from series_summary (see audit_summary.py), so unchanged series aren't read.
+    Returns the number of series updated.
+    """
+    init_series_stats(conn)
+    conn.execute(series_index)
+    stale = [x for (x,) in conn.execute("""SELECT s.series_uid FROM series_summary s
+                                           LEFT JOIN series_stats t ON t.series_uid = s.series_uid
+                                           WHERE t.series_uid IS NULL OR t.n_files != s.n_files""")]
+    now = datetime.now().isoformat()
+    for i in range(0, len(stale), 500):
+        chunk = stale[i:i + 500]
+        rows = conn.execute(f"""SELECT series_uid, instance_number, image_position, number_of_frames FROM dicomdb
+                                WHERE series_uid IN ({', '.join('?' * len(chunk))})""", chunk).fetchall()
+        conn.executemany("""INSERT OR REPLACE INTO series_stats
+                            (series_uid, n_files, n_instances, n_frames, min_instance, max_instance, n_missing,
+                             n_duplicates, min_spacing, max_spacing, status, updated_at)
+                            VALUES (:series_uid, :n_files, :n_instances, :n_frames, :min_instance, :max_instance,
+                                    :n_missing, :n_duplicates, :min_spacing, :max_spacing, :status, :updated_at)""",
+                         [dict(stats, series_uid=uid, updated_at=now) for uid, stats in stats_by_series(rows).items()])
+        conn.commit()
+    return len(stale)
+
+def get_broken_series(conn, study_uid=None):
+    ## [(series_uid, study_uid, modality, status, n_instances, min_instance, max_instance, n_missing)]
+    sql = """SELECT t.series_uid, s.study_uid, s.modality, t.status, t.n_instances, t.min_instance, t.max_instance, t.n_missing
+             FROM series_stats t JOIN series_summary s ON s.series_uid = t.series_uid
+             WHERE t.status NOT IN ('ok', 'unknown')"""
+    if study_uid is None:
+        return conn.execute(sql).fetchall()
+    return conn.execute(sql + " AND s.study_uid = ?", (study_uid,)).fetchall()
+
+def main():
+    conn = sqlite3.connect(db_filename, timeout=60)
+    print(f'Updated stats for {update_series_stats(conn)} series')
+    counts = conn.execute("SELECT status, COUNT(*) FROM series_stats GROUP BY status ORDER BY COUNT(*) DESC").fetchall()
+    print(f'Series by status: {dict(counts)}')
+    for row in get_broken_series(conn)[:50]:
+        print(f'    {row}')
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
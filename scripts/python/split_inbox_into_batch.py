@@ -1,31 +1,121 @@
+"""
+Script for splitting an organised inbox into batches for upload.
+
+Experiments are packed into batches with first-fit decreasing bin packing so every batch stays under
+a byte and a file-count budget (and takes a predictable time to import).
+Moves use a plain rename when source and target are on the same filesystem, and run in parallel.
+Every experiment -> batch assignment is written to the inbox manifest so upload-from-inbox.py
+can read the batches directly (use_batch_manifest = True) and an interrupted run can be resumed.
+"""
 import os
 import glob
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+import inbox_manifest
 
-
+PROJECT = 'STAMPEDE-ACE'
 source_dir ='/mnt/h/ACE_batches'
 target_dir = '/mnt/h/ACE_batches_to_upload'
+manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
+
+## Budgets per batch
+max_batch_bytes = 500 * 1024**3
+max_batch_files = 250_000
+## Parallel moves (only useful when copying across filesystems)
+move_workers = 8
+
+
+def get_sizes(experiments, manifest):
+    ## {experiment path: (n_files, n_bytes)} -- from the manifest if organise recorded it, otherwise stat the files
+    known = inbox_manifest.get_experiments(manifest, PROJECT)
+    sizes = {}
+    for path in tqdm(experiments, desc='Sizing experiments'):
+        expt_id = os.path.basename(path)
+        if expt_id in known:
+            sizes[path] = (known[expt_id]['n_files'], known[expt_id]['n_bytes'])
+        else:
+            files = [f for f in os.scandir(path) if f.is_file()]
+            sizes[path] = (len(files), sum(f.stat().st_size for f in files))
+    return sizes
+
+def pack_batches(sizes, max_bytes=max_batch_bytes, max_files=max_batch_files):
+    """
+    First-fit decreasing: place each experiment (largest first) in the first batch with room for it.
+    Experiments bigger than the budget get a batch of their own.
+    Returns a list of batches, each a list of experiment paths.
+    """
+    batches = [] # [[paths], n_files, n_bytes]
+    for path in sorted(sizes, key=lambda x: sizes[x][1], reverse=True):
+        n_files, n_bytes = sizes[path]
+        for batch in batches:
+            if batch[1] + n_files <= max_files and batch[2] + n_bytes <= max_bytes:
+                batch[0].append(path)
+                batch[1] += n_files
+                batch[2] += n_bytes
+                break
+        else:
+            batches.append([[path], n_files, n_bytes])
+    return [b[0] for b in batches]
+
+def next_batch_number(target):
+    existing = [os.path.basename(x) for x in glob.glob(os.path.join(target, 'batch_*'))]
+    numbers = [int(x.split('_')[1]) for x in existing if x.split('_')[1].isdigit()]
+    return max(numbers, default=0) + 1
 
+def move_experiment(path, output_dir, same_filesystem):
+    destination = os.path.join(output_dir, os.path.basename(path))
+    if os.path.isdir(destination):
+        ## Left by an interrupted copy -- merge what's still in the source into it
+        ## (shutil.move would nest the source inside it, os.rename fails on a non-empty directory)
+        shutil.copytree(path, destination, dirs_exist_ok=True)
+        shutil.rmtree(path)
+    elif same_filesystem:
+        os.rename(path, destination) # Metadata-only, no data copied
+    else:
+        shutil.move(path, destination)
+    return path
 
 def main():
-    inbox = glob.glob(os.path.join(source_dir, '*'))
-    i=0
-    batch_num=1
-    for series in inbox:
-        print(i, series)
-        expt_id = series.replace(source_dir, '')
-        output_dir = os.path.join(target_dir, f'batch_{batch_num}')
-        os.makedirs(output_dir, exist_ok=True)
-        shutil.move(series, output_dir)
-        if i == 1000:
-            # Reset counter and update batch num
-            i=0
-            batch_num += 1
-            
+    manifest = inbox_manifest.init_manifest(manifest_filename)
+    os.makedirs(target_dir, exist_ok=True)
+
+    ## Finish moves from an interrupted run first
+    unfinished = inbox_manifest.get_unmoved_batches(manifest, PROJECT)
+    planned = {}
+    for expt_id, batch in unfinished.items():
+        path = os.path.join(source_dir, expt_id)
+        if os.path.isdir(path):
+            planned.setdefault(batch, []).append(path)
         else:
-            i+=1
-        #break
+            inbox_manifest.mark_moved(manifest, PROJECT, [expt_id])
+    unfinished_paths = {p for paths in planned.values() for p in paths}
+
+    inbox = [x for x in glob.glob(os.path.join(source_dir, '*')) if os.path.isdir(x) and x not in unfinished_paths]
+    sizes = get_sizes(inbox, manifest)
+    batch_num = next_batch_number(target_dir)
+    for paths in pack_batches(sizes):
+        batch = f'batch_{batch_num}'
+        planned[batch] = paths
+        inbox_manifest.record_batch(manifest, PROJECT, batch,
+                                    [(os.path.basename(p), sizes[p][0], sizes[p][1]) for p in paths])
+        batch_num += 1
+    print(f'Moving {sum(len(x) for x in planned.values())} experiments into {len(planned)} batches')
+
+    same_filesystem = os.stat(source_dir).st_dev == os.stat(target_dir).st_dev
+    workers = 1 if same_filesystem else move_workers
+    for batch, paths in planned.items():
+        output_dir = os.path.join(target_dir, batch)
+        os.makedirs(output_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(move_experiment, p, output_dir, same_filesystem) for p in paths]
+            moved = [f.result() for f in tqdm(as_completed(futures), total=len(futures), desc=batch)]
+        inbox_manifest.mark_moved(manifest, PROJECT, [os.path.basename(p) for p in moved])
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
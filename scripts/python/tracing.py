@@ -0,0 +1,188 @@
+"""
+Opt-in tracing shared by the scanner, organise_for_inbox and upload-from-inbox.
+
+Set PIPELINE_TRACE_DIR=/some/dir to record nested timed spans. Each process writes
+trace-{pid}.json in the Chrome trace event format (open in chrome://tracing, Perfetto or speedscope).
+Set PIPELINE_PROFILE=1 as well to sample every thread's stack and write profile-{pid}.folded
+(collapsed stacks for flamegraph.pl / speedscope).
+
+When tracing is off span() returns a shared no-op object, so instrumented code costs one function call.
+
+    with tracing.span('scan_directory', path=path):
+        ...
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+
+trace_dir = os.environ.get('PIPELINE_TRACE_DIR')
+profile = os.environ.get('PIPELINE_PROFILE', '') not in ('', '0')
+profile_interval = float(os.environ.get('PIPELINE_PROFILE_INTERVAL', 0.005)) # seconds between samples
+## Events are buffered and written when a process's outermost span closes, or when this many are waiting
+flush_every = 1000
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    ## One per process -- reopened after a fork so children write their own file
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid = None
+        self.file = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def ensure_open(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.pid = pid
+        self.buffer = []
+        self.local = threading.local()
+        self.file = open(os.path.join(self.directory, f'trace-{pid}.json'), 'w')
+        ## JSON array format: viewers accept a missing closing bracket, so events can be appended as we go
+        self.file.write('[\n')
+        name = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else 'python'
+        self.buffer.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': f'{name} ({pid})'}})
+        atexit.register(self.flush)
+
+    def thread_state(self):
+        ## Per-thread span depth, reset in a forked child
+        if self.pid != os.getpid():
+            with self.lock:
+                self.ensure_open()
+        return self.local
+
+    def add(self, event, top_level=False):
+        with self.lock:
+            self.ensure_open()
+            self.buffer.append(event)
+            if top_level or len(self.buffer) >= flush_every:
+                self.flush_locked()
+
+    def flush_locked(self):
+        if self.file is None or self.pid != os.getpid():
+            return
+        self.file.write(''.join(json.dumps(e) + ',\n' for e in self.buffer))
+        self.file.flush()
+        self.buffer = []
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args):
+        ## Attach results known only at the end of the span (status codes, counts...)
+        self.args.update(args)
+
+    def __enter__(self):
+        self.local = local = self.tracer.thread_state()
+        local.depth = getattr(local, 'depth', 0) + 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        local = self.local
+        local.depth = getattr(local, 'depth', 1) - 1
+        if exc_type is not None:
+            self.args['error'] = repr(exc)
+        event = {'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': self.start / 1000,
+                 'dur': (end - self.start) / 1000, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'args': {k: str(v) for k, v in self.args.items()}}
+        self.tracer.add(event, top_level=local.depth == 0)
+        return False
+
+
+tracer = Tracer(trace_dir) if trace_dir else None
+
+def enabled():
+    return tracer is not None
+
+def span(name, category='pipeline', **args):
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, category, args)
+
+def traced(name=None, category='pipeline'):
+    ## Decorator version of span(). Returns the function untouched when tracing is off.
+    def decorator(fn):
+        if tracer is None:
+            return fn
+        span_name = name or fn.__name__
+        ## functools.wraps keeps __qualname__ so decorated functions can still be pickled for multiprocessing
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Span(tracer, span_name, category, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#### ++++++++++++++++++ SAMPLING PROFILER ++++++++++++++
+def sample_stacks(counts, stop, interval):
+    me = threading.get_ident()
+    while not stop.wait(interval):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+def write_profile(counts, stop, thread):
+    stop.set()
+    thread.join()
+    directory = trace_dir or '.'
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'profile-{os.getpid()}.folded'), 'w') as f:
+        for stack, n in sorted(counts.items(), key=lambda x: -x[1]):
+            f.write(f'{stack} {n}\n')
+
+def start_profiler(interval=None):
+    """
+    Start sampling all threads of this process (if PIPELINE_PROFILE is set).
+    Samples are written to profile-{pid}.folded when the process exits.
+    multiprocessing workers exit without running atexit hooks -- call stop_profiler() at the end of the worker.
+    """
+    if not profile:
+        return None
+    counts = {}
+    stop = threading.Event()
+    thread = threading.Thread(target=sample_stacks, args=(counts, stop, interval or profile_interval), daemon=True)
+    thread.start()
+    atexit.register(write_profile, counts, stop, thread)
+    return counts, stop, thread
+
+def stop_profiler(handle):
+    if handle is not None and not handle[1].is_set():
+        write_profile(*handle)
@@ -1,8 +1,8 @@
 """
 Script for making REST calls to XNAT based on an organised project directory mounted at /data/xnat/inbox
+(or, with transport = 'cstore', sending the files to XNAT's DICOM receiver -- see dicom_transport.py)
 
-TODO:
-- Add monitoring calls. Maybe in a different script? Shell script or python?
+Import throughput can be monitored while this runs with monitor_uploads.py
 """
 import os
 import requests
@@ -11,6 +11,11 @@ import glob
 import time
 import polars as pl
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+import xnat_cache
+import xnat_session
+import inbox_manifest
+import tracing
 
 PROJECT='STAMPEDE-AG'
 #path_to_cert = '/mnt/d/xnat/XNAT-stampede/configs/xnat-release/ssl/xnat-vagrant-CA.pem' 
@@ -19,6 +24,30 @@ PROJECT='STAMPEDE-AG'
 #url = 'http://192.168.56.101:80'
 #url = 'http://172.21.80.1:8080'
 url = 'http://localhost:80'
+## Local cache of what's already in XNAT (see xnat_cache.py)
+cache_filename = './outputs/xnat_cache.db'
+full_refresh = False # Set True to re-download the full listings (picks up deletions)
+## Re-upload experiments that verify_uploads.py found missing/incomplete
+requeue_mismatches = False
+manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
+## Number of imports to run at once and retries for imports that fail with a server/connection error
+max_workers = 1
+max_retries = 3
+retry_backoff = 30 # seconds, multiplied by the attempt number
+## Order to submit experiments in: 'glob', 'largest-first' or 'round-robin-subject'
+upload_order = 'largest-first'
+## Max bytes being imported at once (None = only limited by max_workers)
+max_bytes_in_flight = None
+## 'rest': ask XNAT to import each session from the inbox. 'cstore': send the files over DICOM (needs pynetdicom),
+## using max_workers pooled associations
+transport = 'rest'
+## Create subjects the upload needs before importing, so imports don't create them inline (and contend for them)
+precreate_subjects = True
+subject_workers = 8
+subject_requests_per_second = 20
+## Upload the batches recorded by split_inbox_into_batch.py (batch_root is the directory holding batch_N/)
+use_batch_manifest = False
+batch_root = f'/mnt/d/xnat/1.8/inbox/{PROJECT}/'
 #batch = 'batch_6' ### Last tried 4 - skipping to end
 #source_dir =f'/mnt/d/xnat/1.8/inbox/STAMPEDE-AJ/{batch}/' 
 
@@ -26,79 +55,219 @@ url = 'http://localhost:80'
 # 
 
 def check_xnat(subject_id, experiment_id, **kwargs):
-    ## Check if session to upload has already been uploaded
-    with requests.Session() as sess:
-        sess.auth = ('admin', 'admin')
-        #sess.verify=path_to_cert
-
-        res = sess.get(f"{url}/data/projects/{PROJECT}/subjects/{subject_id}/experiments/{experiment_id}/")
-        if res.status_code == 200: #If exists, return True
-            return True
-        else:
-            return False
+    ## Check if session to upload has already been uploaded (local lookup in the XNAT cache)
+    return xnat_cache.experiment_exists(cache_conn, PROJECT, experiment_id)
 
 def get_experiments_to_skip():
-    ## Check if session to upload has already been uploaded
+    ## Bring the local cache up to date with XNAT (only changes since the last run are requested)
+    ## and return the set of experiment labels already in the project
     with requests.Session() as sess:
         sess.auth = ('admin', 'admin')
         #sess.verify=path_to_cert
+        with tracing.span('refresh_cache'):
+            xnat_cache.refresh_cache(cache_conn, sess, url, PROJECT, full=full_refresh)
+    return xnat_cache.get_experiment_labels(cache_conn, PROJECT)
 
-        res = sess.get(f"{url}/data/projects/{PROJECT}/experiments?format=json")
-        if res.status_code == 200: #If exists, return True
-            return res.json()
-        else:
-            raise ValueError
-
+@tracing.traced()
 def main_loop(source_dir, batch):
     uploads = glob.glob(os.path.join(source_dir, '*'))
     print(f"Submitting {len(uploads)} uploads")
     
     ## Experiments to skip
-    exp_in_project = get_experiments_to_skip()
-    experiments_to_skip = [x['label'] for x in exp_in_project['ResultSet']['Result']] 
+    experiments_to_skip = get_experiments_to_skip()
+    manifest = inbox_manifest.init_manifest(manifest_filename)
+    experiments_to_requeue = set()
+    if requeue_mismatches:
+        experiments_to_requeue = inbox_manifest.get_experiments_to_requeue(manifest, PROJECT)
+        experiments_to_skip = experiments_to_skip - experiments_to_requeue
+        print(f"Re-queueing {len(experiments_to_requeue)} experiments that failed verification")
     print(f"Found {len(experiments_to_skip)} experiments to skip")
     experiments_to_upload = [x for x in uploads if x.replace(source_dir, '') not in experiments_to_skip]
     print(f"Attempting to upload {len(experiments_to_upload)} experiments")
     #exit()
 
+    ## Sizes from the manifest written by organise_for_inbox.py (falls back to listing the directory)
+    with tracing.span('plan_uploads', experiments=len(experiments_to_upload)):
+        sizes = get_experiment_sizes(experiments_to_upload, source_dir, manifest)
+        experiments_to_upload = order_uploads(experiments_to_upload, source_dir, sizes, upload_order)
+    print(f"Uploading {sum(sizes[x][0] for x in experiments_to_upload)} files / "
+          f"{sum(sizes[x][1] for x in experiments_to_upload) / 1e9:.1f} GB in '{upload_order}' order")
+
     fails = 0
-    failed_paths = []
-    for upload in tqdm(experiments_to_upload):
+    results = []
+    if precreate_subjects:
+        with tracing.span('create_missing_subjects'):
+            create_missing_subjects(experiments_to_upload, source_dir)
+    pool = None
+    if transport == 'cstore':
+        import dicom_transport # Only needed (and pynetdicom only required) for C-STORE uploads
+        pool = dicom_transport.AssociationPool(max_workers)
+    with xnat_session.create_session(pool_size=max_workers) as sess:
+        #sess.verify=path_to_cert
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = list(reversed(experiments_to_upload)) # pop() from the end
+            in_flight = {}
+            bytes_in_flight = 0
+            with tqdm(total=len(pending)) as pbar:
+                while pending or in_flight:
+                    ## Keep max_workers imports running, without going over the byte budget
+                    ## (a single experiment bigger than the budget still runs, on its own)
+                    while pending and len(in_flight) < max_workers:
+                        n_bytes = sizes[pending[-1]][1]
+                        if max_bytes_in_flight is not None and in_flight and bytes_in_flight + n_bytes > max_bytes_in_flight:
+                            break
+                        upload = pending.pop()
+                        if pool is None:
+                            future = executor.submit(upload_experiment, sess, upload, source_dir, batch, experiments_to_requeue)
+                        else:
+                            expt_id = upload.replace(source_dir, '')
+                            future = executor.submit(dicom_transport.send_experiment, pool, upload, PROJECT,
+                                                     expt_id.split('_')[0], expt_id, max_retries, retry_backoff)
+                        in_flight[future] = n_bytes
+                        bytes_in_flight += n_bytes
+
+                    with tracing.span('wait_for_uploads', in_flight=len(in_flight), bytes_in_flight=bytes_in_flight):
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        bytes_in_flight -= in_flight.pop(future)
+                        pbar.update(1)
+                        result = future.result()
+                        results.append(result)
+                        if result['status'] != 200:
+                            fails += 1
+                            print(f"Upload failed with status code: {result['status']} -- FAIL # {fails}")
+                        with tracing.span('record_upload', expt_id=result['expt_id'], status=result['status']):
+                            inbox_manifest.record_upload(manifest, PROJECT, result['expt_id'], result['status'],
+                                                         result['attempts'], result['elapsed'])
+
+    if pool is not None:
+        dicom_transport.print_metrics(pool)
+        pool.close()
+    print(f"{fails} of {len(results)} uploads failed")
+    return results
+
+def create_subject(sess, limiter, subject_id):
+    ## PUT one subject, retrying on server/connection errors. Returns the final status code (None if never connected)
+    status = None
+    for attempt in range(1, max_retries + 2):
+        limiter.wait()
+        try:
+            status = sess.put(f"{url}/data/projects/{PROJECT}/subjects/{subject_id}").status_code
+        except requests.exceptions.ConnectionError as e:
+            print(f'Connection error creating subject {subject_id}: {e}')
+            status = None
+        if status is not None and status < 500:
+            break
+        if attempt <= max_retries:
+            time.sleep(retry_backoff * attempt)
+    return subject_id, status
+
+def create_missing_subjects(uploads, source_dir):
+    ## Diff the subjects these uploads need against the cached project listing and create the missing ones concurrently
+    needed = {upload.replace(source_dir, '').split('_')[0] for upload in uploads}
+    missing = sorted(needed - xnat_cache.get_subject_labels(cache_conn, PROJECT))
+    print(f"{len(needed)} subjects needed, {len(missing)} to create")
+    if not missing:
+        return
+    limiter = xnat_session.RateLimiter(subject_requests_per_second)
+    failed = []
+    with xnat_session.create_session(pool_size=subject_workers) as sess:
+        with ThreadPoolExecutor(max_workers=subject_workers) as executor:
+            futures = [executor.submit(create_subject, sess, limiter, x) for x in missing]
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Creating subjects'):
+                subject_id, status = future.result()
+                if status in (200, 201):
+                    xnat_cache.record_subject(cache_conn, PROJECT, subject_id)
+                else:
+                    failed.append((subject_id, status))
+    if failed:
+        ## Imports for these subjects still work -- XNAT creates the subject during the import
+        print(f"Couldn't create {len(failed)} subjects: {failed[:10]}")
+
+def get_experiment_sizes(uploads, source_dir, manifest):
+    ## {upload path: (n_files, n_bytes)}
+    known = inbox_manifest.get_experiments(manifest, PROJECT)
+    sizes = {}
+    for upload in uploads:
         expt_id = upload.replace(source_dir, '')
-        subject_id = expt_id.split('_')[0]
-        if batch is None:
-            path = upload.replace(source_dir, f'/data/xnat/inbox/{PROJECT}/')
+        if expt_id in known:
+            sizes[upload] = (known[expt_id]['n_files'], known[expt_id]['n_bytes'])
         else:
-            path = upload.replace(source_dir, f'/data/xnat/inbox/{PROJECT}/{batch}/')
-        if expt_id in experiments_to_skip:
-            print(f'SKipping {expt_id}')
-            continue
-
-        with requests.Session() as sess:
-            sess.auth = ('admin', 'admin')
-            #sess.verify=path_to_cert
-            print(f'Posting {path} to {subject_id} - {expt_id}')
-            res = sess.post(f"{url}/data/services/import?import-handler=inbox&cleanupAfterImport=false&PROJECT_ID={PROJECT}&SUBJECT_ID={subject_id}&EXPT_LABEL={expt_id}&path={path}")
-            if res.status_code != 200:
-                fails += 1
-                failed_paths.append({'status': res.status_code, 'path': upload})
-                print(f"Upload failed with status code: {res.status_code} -- FAIL # {fails}")
-            # Wait one minute to upload
-            #print('Waiting...')
-            #time.sleep(60)
-
-            #break
-
-
-    return failed_paths
-        #break
+            files = [f for f in os.scandir(upload) if f.is_file()]
+            sizes[upload] = (len(files), sum(f.stat().st_size for f in files))
+    return sizes
+
+def order_uploads(uploads, source_dir, sizes, policy):
+    """
+    Order experiments for submission.
+    largest-first: biggest sessions start first so a batch doesn't finish with a long tail of huge imports.
+    round-robin-subject: one experiment per subject in turn (each subject's largest first),
+    spreading imports for the same subject out in time.
+    """
+    if policy == 'glob':
+        return list(uploads)
+    by_size = sorted(uploads, key=lambda x: sizes[x][1], reverse=True)
+    if policy == 'largest-first':
+        return by_size
+    if policy == 'round-robin-subject':
+        by_subject = {}
+        for upload in by_size:
+            subject_id = upload.replace(source_dir, '').split('_')[0]
+            by_subject.setdefault(subject_id, []).append(upload)
+        queues = list(by_subject.values())
+        ordered = []
+        while queues:
+            ordered.extend(q.pop(0) for q in queues)
+            queues = [q for q in queues if q]
+        return ordered
+    raise ValueError(f'Unknown upload order: {policy}')
+
+def upload_experiment(sess, upload, source_dir, batch, experiments_to_requeue=()):
+    ## POST a single experiment to the inbox import handler, retrying on server/connection errors
+    expt_id = upload.replace(source_dir, '')
+    subject_id = expt_id.split('_')[0]
+    if batch is None:
+        path = upload.replace(source_dir, f'/data/xnat/inbox/{PROJECT}/')
+    else:
+        path = upload.replace(source_dir, f'/data/xnat/inbox/{PROJECT}/{batch}/')
+    overwrite = '&overwrite=append' if expt_id in experiments_to_requeue else ''
+
+    start = time.time()
+    status = None
+    for attempt in range(1, max_retries + 2):
+        print(f'Posting {path} to {subject_id} - {expt_id}')
+        with tracing.span('import', expt_id=expt_id, attempt=attempt) as span:
+            try:
+                res = sess.post(f"{url}/data/services/import?import-handler=inbox&cleanupAfterImport=false&PROJECT_ID={PROJECT}&SUBJECT_ID={subject_id}&EXPT_LABEL={expt_id}&path={path}{overwrite}")
+                status = res.status_code
+            except requests.exceptions.ConnectionError as e:
+                print(f'Connection error posting {expt_id}: {e}')
+                status = None
+            span.set(status=status)
+        ## Only retry if XNAT is overloaded/unavailable -- 4xx won't succeed on a second attempt
+        if status is not None and status < 500:
+            break
+        if attempt <= max_retries:
+            time.sleep(retry_backoff * attempt)
+    return {'path': upload, 'expt_id': expt_id, 'subject_id': subject_id, 'status': status,
+            'attempts': attempt, 'elapsed': time.time() - start}
 
 def main():
+    global cache_conn
+    tracing.start_profiler()
+    cache_conn = xnat_cache.init_cache(cache_filename)
     #batches = ['batch_1', 'batch_2', 'batch_3', 'batch_4', 'batch_5', 'batch_6', 'batch_7', 'batch_8', 'batch_9', 'batch_10']
     batches=None
     #failed_outputs = {}
-    
-    if batches is not None:
+
+    if use_batch_manifest:
+        batches = inbox_manifest.get_batches(inbox_manifest.init_manifest(manifest_filename), PROJECT)
+        print(f"Uploading {len(batches)} batches from the batch manifest")
+        for batch in batches:
+            source_dir = os.path.join(batch_root, batch, '')
+            _ = main_loop(source_dir, batch)
+
+    elif batches is not None:
         for batch in batches:
             #source_dir = f'D:\\xnat\\1.8\\inbox\\STAMPEDE-AJ\\{batch}\\'
             source_dir = f'/mnt/d/xnat/1.8/inbox/{PROJECT}/'
@@ -0,0 +1,155 @@
+"""
+Script for checking that experiments uploaded with upload-from-inbox.py contain every file organise_for_inbox.py wrote.
+
+Compares per-series file counts in the inbox manifest with the scans/resources XNAT reports for each experiment.
+Requests are made concurrently over a pooled session with a rate limit.
+Results go into the `verification` table of the manifest; experiments with status 'missing' or 'mismatch'
+are picked up again by upload-from-inbox.py when requeue_mismatches = True.
+Experiments that match but contain series organise_for_inbox.py flagged as incomplete in the source
+(gaps/duplicated instance numbers, irregular slice spacing) get status 'incomplete_source' -- re-uploading won't fix those.
+With verify_checksums = True, experiments whose counts match also have the MD5 digests XNAT lists for each file
+compared with the checksums organise_for_inbox.py recorded ('checksum_mismatch' if they differ, requeued like 'mismatch').
+This needs checksums enabled in XNAT's site settings, and no anonymisation script editing files on import.
+"""
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+import inbox_manifest
+import xnat_session
+
+PROJECT='STAMPEDE-AG'
+url = 'http://localhost:80'
+manifest_filename = f'./outputs/audit/inbox_manifest_{PROJECT}.db'
+
+## Concurrent requests and max requests per second sent to XNAT
+max_workers = 8
+requests_per_second = 20
+## Resource holding the DICOM files in each scan
+resource_label = 'DICOM'
+## Compare file digests as well as counts (one extra request per scan)
+verify_checksums = False
+
+
+def get_children(item, field):
+    for child in item.get('children', []):
+        if child.get('field') == field:
+            return child.get('items', [])
+    return []
+
+def fetch_resource_file_count(sess, limiter, experiment_id, scan_id):
+    ## Fallback when XNAT hasn't stored file_count on the resource
+    limiter.wait()
+    res = sess.get(f"{url}/data/projects/{PROJECT}/experiments/{experiment_id}/scans/{scan_id}/resources/{resource_label}/files",
+                   params={'format': 'json'})
+    if res.status_code != 200:
+        return None
+    return len(res.json()['ResultSet']['Result'])
+
+def fetch_resource_digests(sess, limiter, experiment_id, scan_id):
+    ## MD5s of the files in a scan's DICOM resource (None where XNAT has no digest)
+    limiter.wait()
+    res = sess.get(f"{url}/data/projects/{PROJECT}/experiments/{experiment_id}/scans/{scan_id}/resources/{resource_label}/files",
+                   params={'format': 'json'})
+    if res.status_code != 200:
+        raise ValueError(f'File listing for {experiment_id} scan {scan_id} failed with status code: {res.status_code}')
+    return [x.get('digest') for x in res.json()['ResultSet']['Result']]
+
+def fetch_series_counts(sess, limiter, experiment_id, scan_ids=None):
+    """
+    Returns {series_uid: n_files} for the scans in an XNAT experiment, or None if the experiment doesn't exist.
+    scan_ids: optional dict, filled with {series_uid: [scan IDs]}
+    """
+    limiter.wait()
+    res = sess.get(f"{url}/data/projects/{PROJECT}/experiments/{experiment_id}", params={'format': 'json'})
+    if res.status_code == 404:
+        return None
+    if res.status_code != 200:
+        raise ValueError(f'Request for {experiment_id} failed with status code: {res.status_code}')
+
+    counts = {}
+    experiment = res.json()['items'][0]
+    for scan in get_children(experiment, 'scans/scan'):
+        fields = scan.get('data_fields', {})
+        series_uid = fields.get('UID', fields.get('ID'))
+        n_files = None
+        for resource in get_children(scan, 'file'):
+            resource_fields = resource.get('data_fields', {})
+            if resource_fields.get('label') == resource_label:
+                n_files = resource_fields.get('file_count')
+        if n_files is None:
+            n_files = fetch_resource_file_count(sess, limiter, experiment_id, fields.get('ID'))
+        counts[series_uid] = counts.get(series_uid, 0) + int(n_files or 0)
+        if scan_ids is not None:
+            scan_ids.setdefault(series_uid, []).append(fields.get('ID'))
+    return counts
+
+def compare_counts(expected, found):
+    ## Returns (status, details) -- details lists every series where the counts disagree
+    if found is None:
+        return 'missing', {}
+    details = {}
+    for series_uid in set(expected) | set(found):
+        n_expected, n_found = expected.get(series_uid, 0), found.get(series_uid, 0)
+        if n_expected != n_found:
+            details[series_uid] = {'expected': n_expected, 'found': n_found}
+    return ('mismatch' if details else 'ok'), details
+
+def compare_checksums(expected, found):
+    ## {series_uid: number of files whose digest doesn't match} -- digests are compared as multisets
+    ## because XNAT renames files on import
+    details = {}
+    for series_uid, digests in expected.items():
+        n_bad = sum((Counter(digests) - Counter(found.get(series_uid, []))).values())
+        if n_bad:
+            details[series_uid] = {'checksum_mismatches': n_bad}
+    return details
+
+def verify_experiment(sess, limiter, experiment_id, expected, incomplete=None, checksums=None):
+    scan_ids = {}
+    try:
+        found = fetch_series_counts(sess, limiter, experiment_id, scan_ids)
+        status, details = compare_counts(expected, found)
+        if status == 'ok' and checksums:
+            digests = {uid: [d for scan_id in ids for d in fetch_resource_digests(sess, limiter, experiment_id, scan_id)]
+                       for uid, ids in scan_ids.items() if uid in checksums}
+            details = compare_checksums(checksums, digests)
+            status = 'checksum_mismatch' if details else 'ok'
+    except Exception as e:
+        return experiment_id, 'error', None, {'error': str(e)}
+    if status == 'ok' and incomplete:
+        status, details = 'incomplete_source', incomplete
+    found_files = None if found is None else sum(found.values())
+    return experiment_id, status, found_files, details
+
+def main():
+    manifest = inbox_manifest.init_manifest(manifest_filename)
+    experiments = inbox_manifest.get_experiments(manifest, PROJECT)
+    expected = {e: inbox_manifest.get_series_counts(manifest, e) for e in experiments}
+    incomplete = {e: inbox_manifest.get_incomplete_series(manifest, e) for e in experiments}
+    checksums = {e: inbox_manifest.get_series_checksums(manifest, e) if verify_checksums else None for e in experiments}
+    print(f"Verifying {len(experiments)} experiments in {PROJECT} with {max_workers} workers")
+
+    limiter = xnat_session.RateLimiter(requests_per_second)
+    statuses = {}
+    with xnat_session.create_session(pool_size=max_workers) as sess:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(verify_experiment, sess, limiter, e, expected[e], incomplete[e], checksums[e]) for e in experiments]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                experiment_id, status, found_files, details = future.result()
+                statuses[status] = statuses.get(status, 0) + 1
+                inbox_manifest.record_verification(manifest, PROJECT, experiment_id, status,
+                                                   experiments[experiment_id]['n_files'], found_files,
+                                                   json.dumps(details))
+                if status != 'ok':
+                    print(f'{experiment_id}: {status} {details}')
+    manifest.commit()
+    print(f"Verification results: {statuses}")
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f'Script finished in: {end - start}')
@@ -0,0 +1,172 @@
+"""
+Local SQLite cache of the subjects and experiments in an XNAT project.
+
+The cache is refreshed incrementally (only entries modified since the last refresh are requested, page by page)
+so upload scripts can check what is already in XNAT with indexed local lookups
+instead of downloading the whole project listing on every run.
+Experiments are only ever added by a refresh: inbox imports finish asynchronously and can still fail
+after the request returns, so a session counts as present only once XNAT lists it.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+
+
+cache_filename = './outputs/xnat_cache.db'
+
+## Number of rows to request per page when listing subjects/experiments
+page_size = 5000
+
+#++++++++++++++  DATABASE SCHEMAS ++++++++++++++++++++
+experiment_schema = """CREATE TABLE IF NOT EXISTS experiments (
+    project_id text NOT NULL,
+    label text NOT NULL,
+    experiment_id text,
+    subject_id text,
+    subject_label text,
+    last_modified text,
+    PRIMARY KEY (project_id, label)
+    );"""
+
+subject_schema = """CREATE TABLE IF NOT EXISTS subjects (
+    project_id text NOT NULL,
+    label text NOT NULL,
+    subject_id text,
+    last_modified text,
+    PRIMARY KEY (project_id, label)
+    );"""
+
+refresh_schema = """CREATE TABLE IF NOT EXISTS refresh_state (
+    project_id text NOT NULL,
+    listing text NOT NULL,
+    last_modified text,
+    refreshed_at text,
+    PRIMARY KEY (project_id, listing)
+    );"""
+
+## Columns requested from XNAT for each listing and how they map onto the cache tables
+listings = {
+    'experiments': {
+        'endpoint': 'experiments',
+        'columns': 'ID,label,subject_ID,subject_label,last_modified',
+        'fields': {'experiment_id': 'ID', 'label': 'label', 'subject_id': 'subject_ID',
+                   'subject_label': 'subject_label', 'last_modified': 'last_modified'},
+    },
+    'subjects': {
+        'endpoint': 'subjects',
+        'columns': 'ID,label,last_modified',
+        'fields': {'subject_id': 'ID', 'label': 'label', 'last_modified': 'last_modified'},
+    },
+}
+
+#### +++++++++++++++++++++++++++++++++++++++++++++++++
+def init_cache(db_file=cache_filename):
+    ## Shared by the uploader and monitor_uploads.py -- WAL and a long busy timeout so one waits for the other
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    cursor = conn.cursor()
+    for schema in [experiment_schema, subject_schema, refresh_schema]:
+        cursor.execute(schema)
+    conn.commit()
+    return conn
+
+def get_watermark(conn, project, listing):
+    res = conn.execute("SELECT last_modified FROM refresh_state WHERE project_id = ? AND listing = ?",
+                       (project, listing)).fetchone()
+    return None if res is None else res[0]
+
+def set_watermark(conn, project, listing, last_modified):
+    conn.execute("""INSERT OR REPLACE INTO refresh_state (project_id, listing, last_modified, refreshed_at)
+                    VALUES (?, ?, ?, ?)""", (project, listing, last_modified, datetime.now().isoformat()))
+
+def modified_since_filter(last_modified):
+    ## XNAT filters dates with an MM/DD/YYYY-MM/DD/YYYY range (whole days).
+    ## Starting on the day of the watermark re-fetches a few rows but upserts are idempotent.
+    start = datetime.fromisoformat(last_modified[:10])
+    end = datetime.now() + timedelta(days=1)
+    return f"{start.strftime('%m/%d/%Y')}-{end.strftime('%m/%d/%Y')}"
+
+def fetch_listing(sess, url, project, listing, since=None):
+    """
+    Generator over all rows of a project listing, requested page by page.
+    If `since` is given only rows modified on or after that date are requested.
+    """
+    spec = listings[listing]
+    params = {'format': 'json', 'columns': spec['columns'], 'sortBy': 'last_modified', 'limit': page_size}
+    if since is not None:
+        params['last_modified'] = modified_since_filter(since)
+
+    offset = 0
+    previous_first = None
+    while True:
+        params['offset'] = offset
+        res = sess.get(f"{url}/data/projects/{project}/{spec['endpoint']}", params=params)
+        if res.status_code != 200:
+            raise ValueError(f'Listing {listing} for {project} failed with status code: {res.status_code}')
+        rows = res.json()['ResultSet']['Result']
+        ## Stop if XNAT ignored the paging parameters and returned everything (or the same page again)
+        first = rows[0] if rows else None
+        if first is not None and first == previous_first:
+            break
+        yield from rows
+        if len(rows) != page_size:
+            break
+        previous_first = first
+        offset += page_size
+
+def refresh_listing(conn, sess, url, project, listing, full=False):
+    spec = listings[listing]
+    table = listing
+    since = None if full else get_watermark(conn, project, listing)
+    if full:
+        conn.execute(f"DELETE FROM {table} WHERE project_id = ?", (project,))
+
+    columns = ['project_id'] + list(spec['fields'].keys())
+    placeholders = ', '.join(['?'] * len(columns))
+    sql = """INSERT OR REPLACE INTO %s (%s) VALUES (%s)""" % (table, ', '.join(columns), placeholders)
+
+    watermark = since
+    num_rows = 0
+    batch = []
+    for row in fetch_listing(sess, url, project, listing, since=since):
+        item = [project] + [row.get(xnat_key) or None for xnat_key in spec['fields'].values()]
+        batch.append(item)
+        last_modified = row.get('last_modified')
+        if last_modified and (watermark is None or last_modified > watermark):
+            watermark = last_modified
+        if len(batch) >= page_size:
+            conn.executemany(sql, batch)
+            num_rows += len(batch)
+            batch = []
+    conn.executemany(sql, batch)
+    num_rows += len(batch)
+
+    set_watermark(conn, project, listing, watermark)
+    conn.commit()
+    return num_rows
+
+def refresh_cache(conn, sess, url, project, full=False):
+    ## Refresh subjects and experiments. Use full=True to also drop entries that were deleted from XNAT.
+    counts = {}
+    for listing in listings:
+        counts[listing] = refresh_listing(conn, sess, url, project, listing, full=full)
+    print(f"Refreshed XNAT cache for {project}: {counts}")
+    return counts
+
+def experiment_exists(conn, project, label):
+    res = conn.execute("SELECT 1 FROM experiments WHERE project_id = ? AND label = ?", (project, label)).fetchone()
+    return res is not None
+
+def subject_exists(conn, project, label):
+    res = conn.execute("SELECT 1 FROM subjects WHERE project_id = ? AND label = ?", (project, label)).fetchone()
+    return res is not None
+
+def get_experiment_labels(conn, project):
+    ## Set of experiment labels in the project -- for O(1) membership tests
+    return {x for (x,) in conn.execute("SELECT label FROM experiments WHERE project_id = ?", (project,))}
+
+def get_subject_labels(conn, project):
+    return {x for (x,) in conn.execute("SELECT label FROM subjects WHERE project_id = ?", (project,))}
+
+def record_subject(conn, project, label):
+    conn.execute("""INSERT OR IGNORE INTO subjects (project_id, label) VALUES (?, ?)""", (project, label))
+    conn.commit()
@@ -0,0 +1,47 @@
+"""
+Helpers for talking to XNAT from several threads at once:
+a requests.Session with a connection pool sized for the number of workers and a simple rate limiter.
+"""
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(pool_size=8, auth=('admin', 'admin'), verify=None):
+    ## One session shared between worker threads, keeps `pool_size` connections alive
+    sess = requests.Session()
+    sess.auth = auth
+    if verify is not None:
+        sess.verify = verify
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return sess
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads: allows `rate` calls per second with bursts of up to `burst` calls.
+    Call wait() before every request.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep_for = (1 - self.tokens) / self.rate
+            time.sleep(sleep_for)